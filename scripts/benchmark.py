@@ -0,0 +1,290 @@
+"""
+Benchmarks for the task loop core. Each scenario is timed several times and the best run is reported, results are
+written as JSON so that runs from different versions can be compared:
+
+    python benchmark.py --output before.json
+    ... make changes ...
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from approxeng.task import Task, SimpleTask, TaskStop, RESOURCES, TASKS, register_resource, register_task, run, \
+    get_resource_total_order, compile_tick_plan, clear_resource_order_cache
+
+# The library logs at info level on task startup, keep that out of the timings. Per tick logging is skipped entirely
+# when debug is disabled.
+logging.basicConfig(level=logging.WARNING)
+
+
+def reset():
+    """
+    Clear out resources and tasks registered by previous scenarios.
+    """
+    RESOURCES.clear()
+    clear_resource_order_cache()
+    for name in [name for name in TASKS if name.startswith('bench_')]:
+        del TASKS[name]
+
+
+def register_flat_resources(count):
+    """
+    Register count independent resources, returning their names.
+    """
+    names = ['res_{}'.format(i) for i in range(count)]
+    for i, name in enumerate(names):
+        register_resource(name, _constant(i))
+    return names
+
+
+def register_resource_chain(depth):
+    """
+    Register a chain of depth resources, each depending on the previous one, returning the name of the last.
+    """
+    register_resource('chain_0', _constant(0))
+    for i in range(1, depth):
+        register_resource('chain_{}'.format(i), _increment('chain_{}'.format(i - 1)))
+    return 'chain_{}'.format(depth - 1)
+
+
+def _constant(value):
+    def resource_function():
+        return value
+
+    return resource_function
+
+
+def _increment(dependency):
+    # Build a function with a parameter named after the dependency, as that's how dependencies are declared
+    namespace = {}
+    exec('def resource_function({0}):\n    return {0} + 1'.format(dependency), namespace)
+    return namespace['resource_function']
+
+
+def _counting_task(ticks, resources):
+    """
+    Build a task which uses the named resources and stops the loop after the given number of ticks.
+    """
+
+    class CountingTask(Task):
+        def startup(self):
+            pass
+
+        def shutdown(self):
+            pass
+
+        def tick(self, world):
+            if world.task_count >= ticks - 1:
+                return TaskStop()
+
+    return CountingTask(name='bench_count', resources=resources)
+
+
+def time_loop(ticks, build):
+    """
+    Time a full run of the task loop, returning seconds per tick.
+
+    :param ticks:
+        Number of ticks to run
+    :param build:
+        Function which registers whatever the scenario needs, and returns a tuple of root task and run arguments
+    """
+    reset()
+    root_task, run_args = build()
+    start = perf_counter()
+    run(root_task=root_task, raise_exceptions=True, **run_args)
+    return (perf_counter() - start) / ticks
+
+
+def time_calls(iterations, func):
+    """
+    Time repeated calls to a no-argument function, returning seconds per call.
+    """
+    start = perf_counter()
+    for _ in range(iterations):
+        func()
+    return (perf_counter() - start) / iterations
+
+
+def scenario_flat_resources(ticks, count):
+    def build():
+        return _counting_task(ticks, register_flat_resources(count)), {}
+
+    return lambda: time_loop(ticks, build)
+
+
+def scenario_dependency_depth(ticks, depth):
+    def build():
+        return _counting_task(ticks, [register_resource_chain(depth)]), {}
+
+    return lambda: time_loop(ticks, build)
+
+
+def scenario_task_switches(ticks, resource_count):
+    def build():
+        names = register_flat_resources(resource_count)
+        remaining = [ticks]
+
+        class SwitchingTask(Task):
+            def __init__(self, name, other):
+                super(SwitchingTask, self).__init__(name=name, resources=names)
+                self.other = other
+
+            def startup(self):
+                pass
+
+            def shutdown(self):
+                pass
+
+            def tick(self, world):
+                remaining[0] -= 1
+                if remaining[0] <= 0:
+                    return TaskStop()
+                return self.other
+
+        register_task('bench_ping', SwitchingTask('bench_ping', 'bench_pong'))
+        register_task('bench_pong', SwitchingTask('bench_pong', 'bench_ping'))
+        return 'bench_ping', {}
+
+    return lambda: time_loop(ticks, build)
+
+
+def scenario_check_tasks(ticks, check_count):
+    def build():
+        def check():
+            return None
+
+        return _counting_task(ticks, []), {'check_tasks': [check] * check_count}
+
+    return lambda: time_loop(ticks, build)
+
+
+def _started_simple_task(resource_count):
+    reset()
+    names = register_flat_resources(resource_count)
+    namespace = {}
+    exec('def bench_function({}):\n    pass'.format(', '.join(names + ['task_count'])), namespace)
+    simple_task = SimpleTask(task_function=namespace['bench_function'], name='bench_simple')
+    simple_task.do_startup()
+    return simple_task
+
+
+def scenario_do_tick(iterations, resource_count):
+    def measure():
+        simple_task = _started_simple_task(resource_count)
+        try:
+            return time_calls(iterations, simple_task.do_tick)
+        finally:
+            simple_task.do_shutdown()
+
+    return measure
+
+
+def scenario_world(iterations, resource_count):
+    def measure():
+        reset()
+        plan = compile_tick_plan(get_resource_total_order(register_flat_resources(resource_count)))
+        return time_calls(iterations, lambda: Task.World(plan=plan, global_count=0, task_count=0))
+
+    return measure
+
+
+def scenario_argument_binding(iterations, resource_count):
+    def measure():
+        simple_task = _started_simple_task(resource_count)
+        world = Task.World(plan=simple_task.tick_plan, global_count=0, task_count=0)
+        try:
+            return time_calls(iterations, lambda: simple_task.tick(world))
+        finally:
+            simple_task.do_shutdown()
+
+    return measure
+
+
+def scenarios(scale):
+    """
+    All benchmark scenarios as (name, parameters, measure function) tuples. Each measure function returns seconds per
+    operation, where an operation is a single tick or call.
+    """
+    ticks = int(2000 * scale)
+    iterations = int(20000 * scale)
+    for count in [0, 1, 10, 50]:
+        yield 'run.flat_resources', {'resources': count}, scenario_flat_resources(ticks, count)
+    for depth in [1, 10, 50]:
+        yield 'run.dependency_depth', {'depth': depth}, scenario_dependency_depth(ticks, depth)
+    for count in [0, 10, 50]:
+        yield 'run.task_switches', {'resources': count}, scenario_task_switches(ticks, count)
+    for count in [0, 1, 10]:
+        yield 'run.check_tasks', {'check_tasks': count}, scenario_check_tasks(ticks, count)
+    for count in [1, 10, 50]:
+        yield 'task.do_tick', {'resources': count}, scenario_do_tick(iterations, count)
+        yield 'task.world', {'resources': count}, scenario_world(iterations, count)
+        yield 'simple_task.argument_binding', {'resources': count}, scenario_argument_binding(iterations, count)
+
+
+def run_benchmarks(scale=1.0, repeat=5, pattern=None):
+    results = []
+    for name, parameters, measure in scenarios(scale):
+        if pattern is not None and pattern not in name:
+            continue
+        timings = [measure() for _ in range(repeat)]
+        best = min(timings)
+        results.append({'name': name,
+                        'parameters': parameters,
+                        'best_seconds': best,
+                        'mean_seconds': sum(timings) / len(timings),
+                        'ops_per_second': 1.0 / best if best > 0 else None})
+        print('{:<30} {:<20} {:>10.2f} us {:>12.0f} /s'.format(
+            name, json.dumps(parameters), best * 1e6, 1.0 / best if best > 0 else 0), file=sys.stderr)
+    reset()
+    return results
+
+
+def compare(results, baseline):
+    """
+    Print the ratio of each result to the matching result in a baseline, values above 1 are slower than the baseline.
+    """
+    baseline_times = {(r['name'], json.dumps(r['parameters'], sort_keys=True)): r['best_seconds']
+                      for r in baseline['results']}
+    print('\nRelative to baseline (>1.0 is slower):', file=sys.stderr)
+    for r in results:
+        key = (r['name'], json.dumps(r['parameters'], sort_keys=True))
+        if key in baseline_times and baseline_times[key] > 0:
+            print('{:<30} {:<20} {:>8.2f}'.format(r['name'], json.dumps(r['parameters']),
+                                                  r['best_seconds'] / baseline_times[key]), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the approxeng.task loop core')
+    parser.add_argument('--output', help='File to write JSON results to, defaults to stdout')
+    parser.add_argument('--compare', help='JSON results from a previous run to compare against')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for the number of ticks and calls')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to repeat each scenario')
+    parser.add_argument('--filter', help='Only run scenarios whose name contains this string')
+    args = parser.parse_args()
+
+    report = {'timestamp': datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'machine': platform.machine(),
+              'repeat': args.repeat,
+              'scale': args.scale,
+              'results': run_benchmarks(scale=args.scale, repeat=args.repeat, pattern=args.filter)}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
+
+
+if __name__ == '__main__':
+    main()
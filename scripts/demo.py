@@ -17,14 +17,13 @@ def bar():
 register_resource('string_resource', 'a value')
 
 
-@resource(name='dep_test_resource')
+@resource(name='dep_test_resource', pure=True)
 def foo(list_resource):
     return list(reversed(list_resource))
 
 
 @task(name='first_task')
 def root(dep_test_resource, task_count):
-    sleep(0.1)
     LOG.info(task_count)
     LOG.info(dep_test_resource)
     if task_count > 2:
@@ -42,4 +41,4 @@ def second_task(string_resource):
 LOG.info(TASKS)
 LOG.info(RESOURCES)
 
-run(root_task='first_task', raise_exceptions=False)
+run(root_task='first_task', raise_exceptions=False, tick_rate=10)
@@ -1,75 +1,180 @@
+import asyncio
 import logging
 from abc import ABC, abstractmethod
 import inspect
+import threading
 import types
-
-TASKS = {}
-RESOURCES = {}
+from collections import deque, namedtuple
+from concurrent.futures import wait, FIRST_COMPLETED
+from time import monotonic, sleep, perf_counter
 
 LOG = logging.getLogger('approxeng.task')
 
 
-def task(_func=None, *, name=None):
+def task(_func=None, *, name=None, tick_rate=None, process=False, wake_on=None, wake_timeout=None, tick_timeout=None):
     """
-    Decorator to indicate that a function is a simple task. The function will be registered, using either the
-    name if explicitly provided, or the name of the function otherwise.
+    Decorator to indicate that a function is a simple task. The function will be registered with the default task
+    loop, using either the name if explicitly provided, or the name of the function otherwise. If tick_rate is
+    specified it overrides the rate passed to :func:`~approxeng.task.run` while this task is active. If process is True
+    the function is called in a separate worker process, see :class:`~approxeng.task.process.ProcessTask`. If wake_on
+    is specified the task only ticks when those resources change, or after wake_timeout seconds, and if tick_timeout is
+    specified a tick which takes longer than that raises a :class:`~approxeng.task.TaskTimeout`, see
+    :class:`~approxeng.task.Task`.
     """
-    if _func is not None:
-        # Called with no name argument
-        register_task(name=_func.__name__, value=_func)
-        return _func
-    else:
-        # Called with an explicit argument, use this to register it
-        def decorator(func):
-            task_name = name if name is not None else func.__name__
-            register_task(name=task_name, value=func)
-            return func
-
-        return decorator
+    return DEFAULT_LOOP.task(_func, name=name, tick_rate=tick_rate, process=process, wake_on=wake_on,
+                             wake_timeout=wake_timeout, tick_timeout=tick_timeout)
 
 
-def resource(_func=None, *, name=None):
+def resource(_func=None, *, name=None, background=False, sample_interval=0, process=False, history=None,
+             max_age=None, pure=False, value_timeout=None, timeout_fallback=None, failure_policy=None):
     """
-    Decorator to indicate that a function produces a resource. If the resource is a static value you should probably
-    use the register_resource instead.
+    Decorator to indicate that a function produces a resource, registered with the default task loop. If the resource
+    is a static value you should probably use the register_resource instead. If background is True the function is
+    called repeatedly on a background thread rather than once per tick, see :class:`~approxeng.task.SampledResource`.
+    If process is True the function is called in a separate worker process, see
+    :class:`~approxeng.task.process.ProcessResource`. If history is set to a number of values, tasks can also read the
+    most recent values through a resource with '_history' appended to the name, see
+    :class:`~approxeng.task.history.HistoryResource`. If max_age is set, the function is only called when the previous
+    value is more than that many seconds old, see :class:`~approxeng.task.CachedResource`. If pure is True, the function
+    is only called when the values of its dependencies change, see :class:`~approxeng.task.PureResource`. If
+    value_timeout is set, a call which takes longer than that many seconds returns timeout_fallback, or raises a
+    :class:`~approxeng.task.TaskTimeout` if there's no fallback, see :class:`~approxeng.task.WatchdogResource`. If a
+    failure_policy is supplied, errors are retried and the last good value used until they persist, see
+    :class:`~approxeng.task.FailurePolicy`.
     """
-    if _func is not None:
-        # Called with no name argument
-        register_resource(_func.__name__, _func)
-        return _func
-    else:
-        # Called with an explicit name argument, use this to register it
-        def decorator(func):
-            register_resource(name, func)
-            return func
-
-        return decorator
+    return DEFAULT_LOOP.resource(_func, name=name, background=background, sample_interval=sample_interval,
+                                 process=process, history=history, max_age=max_age, pure=pure,
+                                 value_timeout=value_timeout, timeout_fallback=timeout_fallback,
+                                 failure_policy=failure_policy)
 
 
 class TaskException(Exception):
     pass
 
 
+class TaskTimeout(TaskException):
+    """
+    Raised when a task tick or resource read takes longer than its time budget. Handled by the task loop like any other
+    exception, so the error task sees it as its error resource.
+    """
+    pass
+
+
+class Watchdog:
+    """
+    Runs calls on a worker thread, waiting no longer than a time limit for each to finish, so the thread running the
+    task loop always regains control even if the call blocks indefinitely. Python can't interrupt a thread, so a call
+    which overruns carries on in the background. Until it finishes any further calls fail immediately rather than
+    queueing up behind it.
+
+    One worker thread is kept for each watchdog, so calls are always made from the same thread.
+    """
+
+    def __init__(self, name):
+        """
+        :param name:
+            Name of whatever is being watched, used in the thread name and in error messages
+        """
+        self.name = name
+        self._requests = deque()
+        self._ready = threading.Condition()
+        self._thread = None
+        self._busy = False
+
+    @property
+    def busy(self):
+        """
+        True while a call is running, including one which has overrun and been abandoned by its caller.
+        """
+        return self._busy
+
+    def call(self, timeout, func, kwargs=None):
+        """
+        Call a function on the worker thread and return its result, raising any exception it raised.
+
+        :param timeout:
+            Seconds to wait for the call to finish
+        :param func:
+            The function to call
+        :param kwargs:
+            Optional dict of keyword arguments to pass to the function
+        :raises TaskTimeout:
+            If the call didn't finish within the timeout, or a previous call still hasn't finished
+        """
+        if self._busy:
+            raise TaskTimeout('"{}" is still blocked in a call which overran its budget'.format(self.name))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name='watchdog-{}'.format(self.name), daemon=True)
+            self._thread.start()
+        # [value, exception]
+        result = [None, None]
+        done = threading.Event()
+        self._busy = True
+        with self._ready:
+            self._requests.append((func, {} if kwargs is None else kwargs, result, done))
+            self._ready.notify()
+        if not done.wait(timeout):
+            raise TaskTimeout('"{}" did not finish within {}s'.format(self.name, timeout))
+        if result[1] is not None:
+            raise result[1]
+        return result[0]
+
+    def _work(self):
+        requests = self._requests
+        while True:
+            with self._ready:
+                while not requests:
+                    self._ready.wait()
+                func, kwargs, result, done = requests.popleft()
+            try:
+                result[0] = func(**kwargs)
+            except Exception as e:
+                result[1] = e
+            finally:
+                self._busy = False
+                done.set()
+
+
 class Task(ABC):
     """
     Abstract base class for tasks, things which are called repeatedly to perform some higher function.
     """
 
+    # Global tick count of the default task loop, other loops keep their own count
     global_count = 0
 
     class World:
         """
         The world that the task tick sees, consists of all resources the task said it needed.
+
+        By default all resources are evaluated when the world is created. A lazy world instead only evaluates a
+        resource, along with any resources it depends on, the first time it's accessed, and then holds on to the value
+        for the rest of the tick. In this case the dict property only contains values which have been accessed so far.
         """
 
-        def __init__(self, resources, global_count, task_count):
-            self.dict = {}
-            for resource_name in resources:
-                res = RESOURCES[resource_name]
-                dependency_values = {name: self.dict[name] for name in res.dependencies}
-                self.dict[resource_name] = res.value(**dependency_values)
-            self.dict['global_count'] = global_count
-            self.dict['task_count'] = task_count
+        def __init__(self, plan, global_count, task_count, cache=None, lazy=False):
+            """
+            :param plan:
+                A tick plan, as produced by :func:`~approxeng.task.compile_tick_plan`, used to evaluate resources
+            :param global_count:
+                Global tick count
+            :param task_count:
+                Number of ticks made by the current task since it was started
+            :param cache:
+                A :class:`~approxeng.task.ResourceCache` holding any resource values already computed during this tick,
+                if None then a new, empty, cache is used and all resources in the plan will be evaluated.
+            :param lazy:
+                If True, only evaluate resources when they're first accessed rather than up front
+            """
+            if cache is None:
+                cache = ResourceCache()
+            self.plan = plan
+            self.cache = cache
+            self.lazy = lazy
+            values = {} if lazy else cache.evaluate(plan)
+            values['global_count'] = global_count
+            values['task_count'] = task_count
+            self.dict = values
 
         def __getitem__(self, item):
             if isinstance(item, tuple):
@@ -77,14 +182,20 @@ class Task(ABC):
             return self.__getattr__(item)
 
         def __getattr__(self, item: str):
-            if item in self.dict:
-                return self.dict[item]
-            raise AttributeError
+            values = self.__dict__.get('dict', {})
+            if item in values:
+                return values[item]
+            if self.__dict__.get('lazy') and item in self.plan.names:
+                value = self.cache.value(item)
+                values[item] = value
+                return value
+            raise AttributeError(item)
 
         def __contains__(self, item):
-            return item in self.dict
+            return item in self.dict or (self.lazy and item in self.plan.names)
 
-    def __init__(self, name, resources=None):
+    def __init__(self, name, resources=None, lazy=False, tick_rate=None, successors=None, wake_on=None,
+                 wake_timeout=None, tick_timeout=None):
         """
         Create a new task
 
@@ -95,6 +206,33 @@ class Task(ABC):
             function. Any such resources will be initialised and shutdown alongside the task itself. If this is
             set to None then all resources registered will be available, otherwise only those explicitly named here
             will be accessible from the task logic.
+        :param lazy:
+            If True, the world passed to each tick will only evaluate resources when the task accesses them, rather
+            than evaluating all of them before the tick. Use this when the task only reads some of its resources on
+            any given tick, especially if resources is None and so includes everything registered.
+        :param tick_rate:
+            Target rate, in ticks per second, while this task is active. If None, the rate passed to
+            :func:`~approxeng.task.run` is used.
+        :param successors:
+            Optional list of names of tasks, or tasks, which this task is likely to hand control to. If the loop is
+            run with prewarm enabled, their resources are started in the background while this task is running.
+        :param wake_on:
+            If None, the default, the task ticks continuously. Otherwise, either a list of resource names, or True for
+            all this task's resources, in which case after its first tick the task only ticks again once one of those
+            resources, or anything they depend on, reports a change through
+            :meth:`~approxeng.task.Resource.notify_changed`, or a resource used by a check task does so. The loop sleeps
+            until then, so an idle task uses no processor time. If any check tasks have no resources, and so can't be
+            woken by a change, the task also ticks once per tick of the loop's tick rate, or every 0.1s if it has none,
+            so the checks keep running. Simulations and replays, which run without pacing, ignore this and tick the
+            task continuously.
+        :param wake_timeout:
+            If wake_on is set, the longest time in seconds to wait for a change before ticking anyway, or None to wait
+            indefinitely.
+        :param tick_timeout:
+            Optional time budget in seconds for each tick, including evaluating resources. If set, ticks are run on a
+            worker thread, and if one takes longer than this the loop stops waiting for it and raises a
+            :class:`~approxeng.task.TaskTimeout`, which is handled by the error task. The tick can't be interrupted, so
+            carries on in the background, but check tasks and the error task are free to stop the robot.
         """
         self._resources = resources
         if resources is not None and not isinstance(resources, list):
@@ -103,6 +241,18 @@ class Task(ABC):
         self.name = name
         self.task_count = 0
         self.ordered_resources = None
+        self.tick_plan = None
+        self.lazy = lazy
+        self.tick_rate = tick_rate
+        self._successors = successors
+        self.wake_on = wake_on
+        self.wake_timeout = wake_timeout
+        self.tick_timeout = tick_timeout
+        self.watchdog = Watchdog(name='task-{}'.format(name)) if tick_timeout is not None else None
+        # Names of resources, including dependencies, whose changes wake this task, worked out on startup
+        self.wake_names = frozenset()
+        # The TaskLoop this task belongs to, set when it's registered with or run by a loop, None for the default loop
+        self.loop = None
 
     @property
     def resources(self):
@@ -111,50 +261,140 @@ class Task(ABC):
         containing all the registered resource names.
         """
         if self._resources is None:
-            return RESOURCES.keys()
+            return self._get_loop().resources.keys()
         return self._resources
 
-    def do_startup(self):
+    def _get_loop(self):
+        return DEFAULT_LOOP if self.loop is None else self.loop
+
+    def _current_tick_plan(self):
+        """
+        The tick plan, compiled again if any resources have been registered since it was last compiled, so a resource
+        replaced while the task is running is picked up on the next tick.
+        """
+        loop = self._get_loop()
+        if self.tick_plan.version != loop.resource_version:
+            self.tick_plan = loop.compile_tick_plan(loop.get_resource_total_order(self.resources))
+        return self.tick_plan
+
+    def successors(self):
+        """
+        Tasks which this task is likely to hand control to, used to warm them up in advance if the loop is run with
+        prewarm enabled. Override this if the likely successors depend on the task's configuration.
+
+        :return:
+            A list of task names or Task objects, defaults to the successors passed to the constructor
+        """
+        return [] if self._successors is None else self._successors
+
+    def prepare(self):
+        """
+        Optionally override to do any expensive setup which can happen before the task is started, such as loading
+        models or reading configuration. If the loop is run with prewarm enabled this is called on a background thread
+        when a task which lists this one as a successor becomes active. It may be called more than once, and may not be
+        called at all, so make sure startup still works if it hasn't been.
+        """
+        pass
+
+    def do_startup(self, manager=None):
         """
         If this task is not currently active, call startup on any required resources, then call startup on the task
         implementation. No need to call this explicitly as it's called if the task isn't active on the first tick.
+
+        This also compiles the tick plan used to build the world on each subsequent tick, so the resource ordering and
+        dependency bindings are only worked out once per activation rather than every tick.
+
+        :param manager:
+            Optional :class:`~approxeng.task.ResourceManager`, if supplied resources are acquired through it so that
+            any already running on behalf of another task or check are left alone. If None, startup is called directly
+            on each resource.
         """
-        self.ordered_resources = get_resource_total_order(self.resources)
+        loop = self._get_loop()
+        self.ordered_resources = loop.get_resource_total_order(self.resources)
         if self.active:
             LOG.warning('Task "%s" startup called but task already active', self.name)
         else:
             LOG.info('Task "%s" starting', self.name)
             for task_resource in self.ordered_resources:
-                if task_resource not in RESOURCES:
+                if task_resource not in loop.resources:
                     raise TaskException('Required resource "{}" not defined'.format(task_resource))
-                RESOURCES[task_resource].startup()
+            if manager is None:
+                for task_resource in self.ordered_resources:
+                    loop.resources[task_resource].startup()
+            else:
+                manager.acquire(self.ordered_resources)
+            self.tick_plan = loop.compile_tick_plan(self.ordered_resources)
+            if self.wake_on is not None:
+                self.wake_names = frozenset(self.ordered_resources if self.wake_on is True else
+                                            loop.get_resource_total_order(self.wake_on))
             self.startup()
             self.active = True
 
-    def do_shutdown(self):
+    def do_shutdown(self, manager=None):
         """
         If this task is active, shut it down, then call shutdown on all resources.
+
+        :param manager:
+            Optional :class:`~approxeng.task.ResourceManager`, if supplied resources are released through it rather
+            than shut down immediately, the manager decides when to actually shut them down.
         """
         if self.active:
             LOG.info('Task "%s" shutting down', self.name)
             self.shutdown()
-            for task_resource in reversed(self.ordered_resources):
-                RESOURCES[task_resource].shutdown()
+            if manager is None:
+                resources = self._get_loop().resources
+                for task_resource in reversed(self.ordered_resources):
+                    resources[task_resource].shutdown()
+            else:
+                manager.release(self.ordered_resources)
             self.active = False
 
-    def do_tick(self):
+    def do_tick(self, cache=None, count=True):
         """
         Start up the task, if needed, then call the tick method, passing in the world and tick count.
+
+        :param cache:
+            Optional :class:`~approxeng.task.ResourceCache` for the current tick, any resource values already held in
+            this cache will be used rather than calling the resource again.
+        :param count:
+            If True, the default, advance the task and global tick counts afterwards. Set to False when ticking from
+            another thread, the caller is then responsible for advancing them.
         """
         if not self.active:
             self.do_startup()
-        LOG.debug('Task "%s", task_tick %i, global_tick %i', self.name, self.task_count, Task.global_count)
+        loop = self._get_loop()
+        if cache is None:
+            cache = ResourceCache(resources=loop.resources)
         return_value = self.tick(
-            world=Task.World(resources=self.ordered_resources,
+            world=Task.World(plan=self._current_tick_plan(),
                              task_count=self.task_count,
-                             global_count=Task.global_count))
-        Task.global_count = Task.global_count + 1
-        self.task_count = self.task_count + 1
+                             global_count=loop.global_count,
+                             cache=cache,
+                             lazy=self.lazy))
+        if count:
+            loop.global_count = loop.global_count + 1
+            self.task_count = self.task_count + 1
+        return return_value
+
+    async def do_tick_async(self, cache=None):
+        """
+        Asynchronous version of :meth:`~approxeng.task.Task.do_tick`. Resources in the tick plan are evaluated
+        concurrently where their dependencies allow, awaiting any which return awaitables, and the result of the tick
+        is awaited if the task's tick method is a coroutine. Lazy tasks are evaluated eagerly here, as attribute access
+        on the world can't be awaited.
+
+        :param cache:
+            Optional :class:`~approxeng.task.ResourceCache` for the current tick
+        """
+        if not self.active:
+            self.do_startup()
+        if cache is None:
+            cache = ResourceCache(resources=self._get_loop().resources)
+        await cache.evaluate_async(self._current_tick_plan())
+        # All values are now in the cache, so building the world won't call any resources
+        return_value = self.do_tick(cache=cache)
+        if inspect.isawaitable(return_value):
+            return_value = await return_value
         return return_value
 
     @abstractmethod
@@ -201,7 +441,7 @@ class SimpleTask(Task):
     count : monotonically ascending tick count across the entire application.
     """
 
-    def __init__(self, task_function, name):
+    def __init__(self, task_function, name, tick_rate=None, wake_on=None, wake_timeout=None, tick_timeout=None):
         """
         Create a new simple task instance, this is generally going to be called from within the library when wrapping
         a task function.
@@ -213,20 +453,35 @@ class SimpleTask(Task):
         :param name:
             The name of the task, this is only really used internally for logging, the canonical name is defined by the
             key under which the task is registered.
+        :param tick_rate:
+            Optional target tick rate while this task is active, overriding the rate passed to the task loop.
+        :param wake_on:
+            Optional resource names, or True for all the task's resources, which must change before the task ticks
+            again, see :class:`~approxeng.task.Task`
+        :param wake_timeout:
+            Longest time in seconds to wait for a change if wake_on is set
+        :param tick_timeout:
+            Optional time budget in seconds for each tick, see :class:`~approxeng.task.Task`
         """
 
         self.all_args = list(inspect.signature(task_function).parameters.keys())
         resources = [res for res in self.all_args if res not in ['task_state', 'task_count', 'global_count']]
 
-        super(SimpleTask, self).__init__(resources=resources, name=name)
+        super(SimpleTask, self).__init__(resources=resources, name=name, tick_rate=tick_rate, wake_on=wake_on,
+                                         wake_timeout=wake_timeout, tick_timeout=tick_timeout)
         self.task_function = task_function
         self.state = {}
+        self.bound_args = ()
 
     def startup(self):
         """
-        Clear the state dict, this should never be needed but doesn't hurt to check
+        Clear the state dict, this should never be needed but doesn't hurt to check. Also work out which of the task
+        function's arguments can be supplied from the world, as this won't change until the next activation.
         """
         self.state.clear()
+        available = set(self.ordered_resources)
+        available.update(['task_state', 'task_count', 'global_count'])
+        self.bound_args = tuple(arg for arg in self.all_args if arg in available)
 
     def shutdown(self):
         """
@@ -246,13 +501,153 @@ class SimpleTask(Task):
             TaskStop - exit from the task processing loop, shutting down the process
             Task or String - shut this task down, set the named or provided task as the current task
         """
-        world.dict.update({'task_state': self.state})
-        return self.task_function(**{name: world.dict[name] for name in world.dict if name in self.all_args})
+        values = world.dict
+        values['task_state'] = self.state
+        return self.task_function(**{arg: values[arg] for arg in self.bound_args})
+
+
+class ParallelTask(Task):
+    """
+    Task which runs several child tasks side by side, so things like an LED animation or telemetry can keep running
+    alongside whichever task is driving the robot. Children are started and shut down with the parallel task, and
+    ticked in order on each of its ticks, or less often if they have a lower tick rate of their own. All children share
+    the same tick's resource values, so a resource used by several of them is still only read once per tick.
+
+    The first response other than None from any child is used as the response of the parallel task, so any child can
+    switch control to another task or stop the loop, at which point all the children are shut down. When run with
+    :func:`~approxeng.task.run_async` children may be coroutines, and every child which ticks is awaited.
+
+    Children are ticked directly by the parallel task, so they can't have a tick_timeout or wake_on of their own, and
+    starting a parallel task with such a child raises a TaskException.
+
+    .. code-block:: python
+
+        from approxeng.task import register_task, ParallelTask
+
+        register_task('drive_with_lights', ParallelTask(name='drive_with_lights',
+                                                        tasks=['drive', 'lights', 'telemetry']))
+    """
+
+    def __init__(self, name, tasks, tick_rate=None):
+        """
+        :param name:
+            Name of the task
+        :param tasks:
+            List of child tasks, either names of registered tasks or Task objects
+        :param tick_rate:
+            Rate at which to tick, children with a lower tick rate are ticked less often. Defaults to the fastest rate
+            of any child if they all have one, otherwise the rate of the task loop.
+        """
+        super(ParallelTask, self).__init__(name=name, lazy=True, tick_rate=tick_rate)
+        self._tasks = tasks
+        self.children = []
+        # Child -> monotonic time at which it's next due to tick, for children with their own tick rate
+        self._next_tick = {}
+
+    @property
+    def resources(self):
+        """
+        All resources needed by any of the child tasks which have been registered so far.
+        """
+        tasks = self._get_loop().tasks
+        names = []
+        for child in self._tasks:
+            child = child if isinstance(child, Task) else tasks.get(child)
+            if child is not None:
+                names.extend(name for name in child.resources if name not in names)
+        return names
+
+    def do_startup(self, manager=None):
+        """
+        Start all the child tasks, along with their resources, then this task.
+        """
+        if self.active:
+            LOG.warning('Task "%s" startup called but task already active', self.name)
+            return
+        LOG.info('Task "%s" starting', self.name)
+        loop = self._get_loop()
+        self.children = [loop.get_task(child) for child in self._tasks]
+        for child in self.children:
+            if child.tick_timeout is not None or child.wake_on is not None:
+                raise TaskException('Task "{}" sets tick_timeout or wake_on, which are ignored when run by parallel '
+                                    'task "{}"'.format(child.name, self.name))
+        started = []
+        try:
+            for child in self.children:
+                child.do_startup(manager=manager)
+                started.append(child)
+        except Exception:
+            # Don't leave the children which did start holding their resources, as this task isn't active so won't
+            # shut them down
+            for child in reversed(started):
+                child.do_shutdown(manager=manager)
+            raise
+        if self.tick_rate is None and self.children and all(child.tick_rate for child in self.children):
+            self.tick_rate = max(child.tick_rate for child in self.children)
+        self.ordered_resources = loop.get_resource_total_order(self.resources)
+        self.tick_plan = loop.compile_tick_plan(self.ordered_resources)
+        self.startup()
+        self.active = True
+
+    def do_shutdown(self, manager=None):
+        """
+        Shut this task down, then all the child tasks in reverse order.
+        """
+        if self.active:
+            LOG.info('Task "%s" shutting down', self.name)
+            self.shutdown()
+            for child in reversed(self.children):
+                child.do_shutdown(manager=manager)
+            self.active = False
+
+    def startup(self):
+        self._next_tick.clear()
+
+    def shutdown(self):
+        pass
+
+    def tick(self, world):
+        now = monotonic()
+        cache = world.cache
+        global_count = world.global_count
+        responses = []
+        for child in self.children:
+            if child.tick_rate is not None and child.tick_rate != self.tick_rate:
+                due = self._next_tick.get(child, now)
+                if now < due:
+                    continue
+                period = 1.0 / child.tick_rate
+                # Don't try to catch up if the child has fallen more than a tick behind
+                self._next_tick[child] = due + period if now - due < period else now + period
+            child_response = child.tick(world=Task.World(plan=child._current_tick_plan(),
+                                                         task_count=child.task_count,
+                                                         global_count=global_count,
+                                                         cache=cache,
+                                                         lazy=child.lazy))
+            child.task_count = child.task_count + 1
+            responses.append(child_response)
+        if any(inspect.isawaitable(child_response) for child_response in responses):
+            # Some children are coroutines, so await all of them before picking the response
+            return self._first_response_async(responses)
+        return next((child_response for child_response in responses if child_response is not None), None)
+
+    @staticmethod
+    async def _first_response_async(responses):
+        """
+        Await any awaitable child responses, in order, and return the first which isn't None.
+        """
+        response = None
+        for child_response in responses:
+            if inspect.isawaitable(child_response):
+                child_response = await child_response
+            if response is None:
+                response = child_response
+        return response
 
 
-def register_task(name, value):
+def register_task(name, value, tick_rate=None, process=False, wake_on=None, wake_timeout=None, tick_timeout=None):
     """
-    Explicitly register a task, either from a function or from an instance of Task
+    Explicitly register a task with the default task loop, either from a function or from an instance of Task
 
     :param name:
         Name used to reference the task
@@ -261,13 +656,20 @@ def register_task(name, value):
         object. You may want to use the latter, more verbose, form if extensive setup or custom state handling is
         needed by your task, although in general most of such handling should be done with resources and tasks
         themselves should remain largely state free.
+    :param tick_rate:
+        Target tick rate for a task function, ignored if value is a Task, in which case set it on the task directly.
+    :param process:
+        If True, and value is a task function, call it in a separate worker process. Ignored for Task objects.
+    :param wake_on:
+        Resources which must change before a task function ticks again, ignored for Task objects, see
+        :class:`~approxeng.task.Task`
+    :param wake_timeout:
+        Longest time in seconds to wait for a change if wake_on is set, ignored for Task objects
+    :param tick_timeout:
+        Time budget in seconds for each tick of a task function, ignored for Task objects
     """
-    if isinstance(value, types.FunctionType):
-        TASKS[name] = SimpleTask(name=name, task_function=value)
-        LOG.info('Registered task function "%s", required resources: %s', name, TASKS[name].resources)
-    elif isinstance(value, Task):
-        TASKS[name] = value
-        LOG.info('Registered task class "%s", required resources: %s', name, value.resources)
+    DEFAULT_LOOP.register_task(name=name, value=value, tick_rate=tick_rate, process=process, wake_on=wake_on,
+                               wake_timeout=wake_timeout, tick_timeout=tick_timeout)
 
 
 class Resource(ABC):
@@ -278,7 +680,8 @@ class Resource(ABC):
     resource has its shutdown function called.
     """
 
-    def __init__(self, name, dependencies=None):
+    def __init__(self, name, dependencies=None, max_age=None, pure=False, value_timeout=None, timeout_fallback=None,
+                 failure_policy=None):
         """
         :param name:
             Name used when referencing this resource
@@ -287,14 +690,47 @@ class Resource(ABC):
             of things, firstly it determines the order of startup and shutdown (with resources being started after their
             dependencies and shut down before them), and secondly it causes any specified dependencies to be provided
             as parameters to the value(..) method.
+        :param max_age:
+            Optional time in seconds for which each value may be reused. If set, when the resource is registered it's
+            wrapped in a :class:`~approxeng.task.CachedResource` so the value method is only called once the previous
+            value is older than this.
+        :param pure:
+            If True, the value depends only on the values of the dependencies, so when the resource is registered it's
+            wrapped in a :class:`~approxeng.task.PureResource` and the value method is only called when one of them
+            changes.
+        :param value_timeout:
+            Optional time budget in seconds for each call to the value method. If set, when the resource is registered
+            it's wrapped in a :class:`~approxeng.task.WatchdogResource` so a read which hangs can't stall the loop.
+        :param timeout_fallback:
+            Value to use when a read overruns the value_timeout, if None a :class:`~approxeng.task.TaskTimeout` is
+            raised instead.
+        :param failure_policy:
+            Optional :class:`~approxeng.task.FailurePolicy`. If set, when the resource is registered it's wrapped in a
+            :class:`~approxeng.task.CircuitBreakerResource` so occasional errors from the value method are smoothed
+            over rather than passing control to the error task.
         """
         self._dependencies = dependencies
         self.name = name
+        self.max_age = max_age
+        self.pure = pure
+        self.value_timeout = value_timeout
+        self.timeout_fallback = timeout_fallback
+        self.failure_policy = failure_policy
+        # The TaskLoop this resource is registered with, None for the default loop
+        self.loop = None
 
     @property
     def dependencies(self):
         return [] if self._dependencies is None else self._dependencies
 
+    def notify_changed(self):
+        """
+        Signal that this resource has a new value, waking any task which is waiting for it to change. Safe to call
+        from any thread, such as a background reader or a callback from a hardware interrupt.
+        """
+        loop = getattr(self, 'loop', None)
+        (DEFAULT_LOOP if loop is None else loop).notify_changed(self.name)
+
     @abstractmethod
     def startup(self):
         """
@@ -323,42 +759,362 @@ class Resource(ABC):
 
 def get_resource_total_order(resources=None):
     """
-    Resolve a set of resources into an ordering which respects any dependencies, this will also extend the supplied list
-    to include any transitive dependencies if required.
+    Resolve a set of resources registered with the default task loop into an ordering which respects any dependencies,
+    see :meth:`~approxeng.task.TaskLoop.get_resource_total_order`.
+    """
+    return DEFAULT_LOOP.get_resource_total_order(resources)
 
-    :param resources:
-        An iterable of resource names, or None to use all names
-    :return:
-        A list of resource names such that no resource depends on a resource later in the list
+
+def clear_resource_order_cache():
     """
+    Discard all cached resource orderings for the default task loop, called automatically when resources are
+    registered.
+    """
+    DEFAULT_LOOP.clear_resource_order_cache()
+
 
-    all_resources = list([res for res in resources if res in RESOURCES]) if resources is not None else list(
-        RESOURCES.keys())
+def _resolve_resource_order(resources, registry):
+    """
+    Topologically sort the named resources, along with any transitive dependencies, using Kahn's algorithm. Names
+    which aren't in the registry dict are ignored, but an unregistered dependency of a registered resource is an error.
+    """
+    # Collect requested resources along with transitive dependencies, in the order they're first seen
+    all_resources = []
+    seen = set()
+    for name in resources:
+        if name in registry and name not in seen:
+            seen.add(name)
+            all_resources.append(name)
     for name in all_resources:
-        res = RESOURCES[name]
-        if res.dependencies is not None:
-            for dep_name in res.dependencies:
-                if dep_name not in all_resources:
-                    LOG.info('Adding transitive dependency %s for %s', dep_name, name)
-                    all_resources.append(dep_name)
-
-    unresolved_names = set(all_resources)
+        for dep_name in registry[name].dependencies:
+            if dep_name not in seen:
+                if dep_name not in registry:
+                    raise TaskException('Resource "{}" depends on "{}", which is not defined'.format(name, dep_name))
+                LOG.debug('Adding transitive dependency %s for %s', dep_name, name)
+                seen.add(dep_name)
+                all_resources.append(dep_name)
+
+    # Number of unresolved dependencies for each resource, and an index from each resource to those depending on it
+    remaining = {}
+    dependants = {}
+    for name in all_resources:
+        dependencies = set(registry[name].dependencies)
+        remaining[name] = len(dependencies)
+        for dep_name in dependencies:
+            dependants.setdefault(dep_name, []).append(name)
+
+    ready = deque(name for name in all_resources if remaining[name] == 0)
     resolved_names = []
-    while unresolved_names:
-        found_something = False
-        for name in unresolved_names:
-            res = RESOURCES[name]
-            if res.dependencies is None or all(dep_name in resolved_names for dep_name in res.dependencies):
-                LOG.info('Resolved ordering for %s', name)
-                resolved_names.append(name)
-                found_something = True
-        if not found_something:
-            message = 'Cyclic dependencies in requested resources {}'.format(resources)
-            LOG.error(message)
-            raise ValueError(message)
-        for name in resolved_names:
-            unresolved_names.discard(name)
-    return resolved_names
+    while ready:
+        name = ready.popleft()
+        resolved_names.append(name)
+        for dependant in dependants.get(name, ()):
+            remaining[dependant] -= 1
+            if remaining[dependant] == 0:
+                ready.append(dependant)
+
+    if len(resolved_names) < len(all_resources):
+        message = 'Cyclic dependencies in requested resources: {}'.format(' -> '.join(_find_cycle(remaining, registry)))
+        LOG.error(message)
+        raise ValueError(message)
+    LOG.debug('Resolved resource ordering %s', resolved_names)
+    return tuple(resolved_names)
+
+
+def _find_cycle(remaining, registry):
+    """
+    Find a single dependency cycle among resources left unresolved by the topological sort. Every such resource has at
+    least one unresolved dependency, so following those from any of them must eventually revisit a resource.
+
+    :return:
+        List of names forming the cycle, starting and ending with the same name
+    """
+    unresolved = {name for name, count in remaining.items() if count > 0}
+    path = []
+    position = {}
+    name = min(unresolved)
+    while name not in position:
+        position[name] = len(path)
+        path.append(name)
+        name = next(dep_name for dep_name in registry[name].dependencies if dep_name in unresolved)
+    return path[position[name]:] + [name]
+
+
+class TickPlan:
+    """
+    A precompiled sequence of resource evaluations, built when a task starts and used on each tick to build the world.
+    """
+
+    def __init__(self, steps, version=None):
+        """
+        :param steps:
+            A tuple of (name, resource, dependencies) tuples, where dependencies is a tuple of the names of resources
+            which must be passed to the resource's value method. Evaluating the steps in order is guaranteed to have
+            computed all dependencies before they're needed.
+        :param version:
+            The resource_version of the :class:`~approxeng.task.TaskLoop` the plan was compiled from. Once that changes
+            the resources in the steps may have been replaced, so the plan must be compiled again before it's used.
+        """
+        self.steps = steps
+        self.version = version
+        self.names = frozenset(name for name, _, _ in steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+
+def compile_tick_plan(ordered_resources):
+    """
+    Compile a tick plan from an ordered list of names of resources registered with the default task loop, see
+    :meth:`~approxeng.task.TaskLoop.compile_tick_plan`.
+    """
+    return DEFAULT_LOOP.compile_tick_plan(ordered_resources)
+
+
+class ResourceCache:
+    """
+    Holds resource values computed during a single tick, so that each resource is evaluated at most once per tick no
+    matter how many check tasks or worlds ask for it. The task loop owns one of these and clears it at the start of
+    each tick.
+
+    If an executor is supplied, plans are evaluated concurrently. Each resource is submitted to the executor as soon
+    as all its dependencies are available, so the time taken to evaluate a plan approaches that of the slowest chain
+    of dependent resources rather than the sum of all of them. Resource value methods must be safe to call from a
+    thread other than the one running the task loop if you use this.
+    """
+
+    def __init__(self, executor=None, profiler=None, resources=None):
+        """
+        :param executor:
+            Optional :class:`concurrent.futures.Executor`, normally a :class:`~concurrent.futures.ThreadPoolExecutor`,
+            used to evaluate independent resources at the same time. If None, resources are evaluated one at a time.
+        :param profiler:
+            Optional :class:`~approxeng.task.profiling.Profiler`, if supplied the time taken by each resource value call
+            is recorded in the 'resource' category.
+        :param resources:
+            Dict of name to resource used to look up resources evaluated by name, defaults to those registered with the
+            default task loop.
+        """
+        self.values = {}
+        self.executor = executor
+        self.profiler = profiler
+        self.resources = DEFAULT_LOOP.resources if resources is None else resources
+
+    def clear(self):
+        """
+        Discard all cached values, call this at the start of each tick.
+        """
+        self.values.clear()
+
+    def value(self, name):
+        """
+        Get the value of a single named resource, evaluating it and any of its dependencies if they haven't already
+        been evaluated during this tick.
+
+        :param name:
+            Name of the resource
+        :return:
+            The resource value
+        """
+        values = self.values
+        if name in values:
+            return values[name]
+        res = self.resources[name]
+        value = self._call(name, res, {dep_name: self.value(dep_name) for dep_name in res.dependencies})
+        values[name] = value
+        return value
+
+    def _call(self, resource_name, res, kwargs):
+        """
+        Call a resource's value method, timing it if there's a profiler.
+        """
+        profiler = self.profiler
+        if profiler is None:
+            return res.value(**kwargs)
+        start = perf_counter()
+        try:
+            return res.value(**kwargs)
+        finally:
+            profiler.record('resource', resource_name, perf_counter() - start)
+
+    async def evaluate_async(self, plan):
+        """
+        Evaluate a tick plan asynchronously, caching the results. Each resource which isn't already cached is evaluated
+        as soon as all its dependencies are available, so independent resources which return awaitables are awaited
+        concurrently.
+
+        :param plan:
+            A tick plan, as produced by :func:`~approxeng.task.compile_tick_plan`
+        """
+        cached = self.values
+        pending = {}
+
+        async def dependency_value(dep_name):
+            if dep_name in cached:
+                return cached[dep_name]
+            return await pending[dep_name]
+
+        async def evaluate_step(resource_name, res, dependencies):
+            kwargs = {dep_name: await dependency_value(dep_name) for dep_name in dependencies}
+            start = perf_counter()
+            value = res.value(**kwargs)
+            if inspect.isawaitable(value):
+                value = await value
+            if self.profiler is not None:
+                self.profiler.record('resource', resource_name, perf_counter() - start)
+            return value
+
+        for resource_name, res, dependencies in plan.steps:
+            if resource_name not in cached:
+                pending[resource_name] = asyncio.ensure_future(evaluate_step(resource_name, res, dependencies))
+        if pending:
+            try:
+                await asyncio.gather(*pending.values())
+            except Exception:
+                for future in pending.values():
+                    future.cancel()
+                raise
+            for resource_name, future in pending.items():
+                cached[resource_name] = future.result()
+
+    def evaluate(self, plan):
+        """
+        Evaluate a tick plan, using cached values where available and caching any newly computed ones.
+
+        :param plan:
+            A tick plan, as produced by :func:`~approxeng.task.compile_tick_plan`
+        :return:
+            A new dict of resource name to value, containing only the resources in the plan
+        """
+        if self.executor is not None and len(plan) > 1:
+            return self._evaluate_concurrently(plan)
+        cached = self.values
+        profiler = self.profiler
+        values = {}
+        for resource_name, res, dependencies in plan.steps:
+            if resource_name in cached:
+                value = cached[resource_name]
+            elif profiler is not None:
+                value = self._call(resource_name, res, {dep_name: values[dep_name] for dep_name in dependencies})
+                cached[resource_name] = value
+            elif dependencies:
+                value = res.value(**{dep_name: values[dep_name] for dep_name in dependencies})
+                cached[resource_name] = value
+            else:
+                value = res.value()
+                cached[resource_name] = value
+            values[resource_name] = value
+        return values
+
+    def _evaluate_concurrently(self, plan):
+        """
+        Evaluate a plan using the executor, submitting each resource once its dependencies are all available.
+        """
+        cached = self.values
+        executor = self.executor
+        values = {}
+        # Resources waiting for dependencies, name -> [resource, dependencies, number of dependencies not yet known]
+        waiting = {}
+        # Dependency name -> list of names of waiting resources which need it
+        dependants = {}
+        # Future -> name of the resource it's evaluating
+        running = {}
+
+        def submit(resource_name, res, dependencies):
+            future = executor.submit(self._call, resource_name, res,
+                                     {dep_name: values[dep_name] for dep_name in dependencies})
+            running[future] = resource_name
+
+        for resource_name, res, dependencies in plan.steps:
+            if resource_name in cached:
+                values[resource_name] = cached[resource_name]
+                continue
+            missing = [dep_name for dep_name in dependencies if dep_name not in values]
+            if missing:
+                waiting[resource_name] = [res, dependencies, len(missing)]
+                for dep_name in missing:
+                    dependants.setdefault(dep_name, []).append(resource_name)
+            else:
+                submit(resource_name, res, dependencies)
+        try:
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    resource_name = running.pop(future)
+                    value = future.result()
+                    values[resource_name] = value
+                    cached[resource_name] = value
+                    for dependant in dependants.get(resource_name, ()):
+                        entry = waiting[dependant]
+                        entry[2] -= 1
+                        if entry[2] == 0:
+                            del waiting[dependant]
+                            submit(dependant, entry[0], entry[1])
+        except Exception:
+            # Don't start anything else from this plan, anything already running will finish in the background
+            for future in running:
+                future.cancel()
+            raise
+        return values
+
+
+class CheckTask:
+    """
+    Wraps a check task function, as passed to :func:`~approxeng.task.run`. Check task functions may accept parameters,
+    in which case these are interpreted as resource names in the same way as for simple tasks, and are supplied from the
+    same per-tick cache as the active task so that each resource is only read once per tick. The global_count parameter
+    is also available.
+    """
+
+    def __init__(self, check_function):
+        self.check_function = check_function
+        self.name = getattr(check_function, '__name__', repr(check_function))
+        self.all_args = list(inspect.signature(check_function).parameters.keys())
+        self.resources = [arg for arg in self.all_args if arg != 'global_count']
+        self.ordered_resources = []
+        self.tick_plan = None
+        self.bound_args = ()
+        self.loop = None
+
+    def compile(self, loop=None):
+        """
+        Resolve the resources needed by this check, call once before the task loop starts.
+
+        :param loop:
+            The :class:`~approxeng.task.TaskLoop` providing resources, defaults to the default loop
+        """
+        if loop is None:
+            loop = DEFAULT_LOOP
+        self.loop = loop
+        self.ordered_resources = loop.get_resource_total_order(self.resources)
+        self.tick_plan = loop.compile_tick_plan(self.ordered_resources)
+        available = set(self.ordered_resources)
+        available.add('global_count')
+        self.bound_args = tuple(arg for arg in self.all_args if arg in available)
+
+    def __call__(self, cache, global_count):
+        if not self.bound_args:
+            return self.check_function()
+        values = cache.evaluate(self._current_tick_plan())
+        values['global_count'] = global_count
+        return self.check_function(**{arg: values[arg] for arg in self.bound_args})
+
+    def _current_tick_plan(self):
+        if self.tick_plan.version != self.loop.resource_version:
+            self.tick_plan = self.loop.compile_tick_plan(self.loop.get_resource_total_order(self.resources))
+        return self.tick_plan
+
+    async def call_async(self, cache, global_count):
+        """
+        Asynchronous version of calling the check, awaits any awaitable resources and the result of the check function
+        if it's a coroutine.
+        """
+        if self.bound_args:
+            await cache.evaluate_async(self._current_tick_plan())
+        response = self(cache=cache, global_count=global_count)
+        if inspect.isawaitable(response):
+            response = await response
+        return response
 
 
 class SimpleResource(Resource):
@@ -384,138 +1140,1872 @@ class SimpleResource(Resource):
         return self.value_func(**kwargs)
 
 
-def register_resource(name, value):
+Sample = namedtuple('Sample', ['value', 'age'])
+Sample.__doc__ = """
+The most recent value from a :class:`~approxeng.task.SampledResource`, along with its age in seconds.
+"""
+
+
+# Range of delays after a sample function raises an exception before it's called again
+_MIN_SAMPLE_BACKOFF = 0.01
+_MAX_SAMPLE_BACKOFF = 1.0
+
+
+class SampledResource(Resource):
     """
-    Explicitly register a value as a resource. If the value is a function then wrap it up as the value() method of a
-    resource class instance. If it is already a resource class instance just register it. If it's a plain static value
-    then wrap it in a function that always returns that value, then wrap that up in the simple class.
+    Resource which calls its sample function repeatedly on a background thread, rather than once per tick. Use this
+    for things like cameras or lidar units which produce data at their own rate, and where reading the next value would
+    otherwise stall the task loop until it arrives.
+
+    Only the most recent sample is kept, and it's replaced as a single reference so reading it never blocks on the
+    sampling thread. The value seen by tasks is a :class:`~approxeng.task.Sample` containing the value and how many
+    seconds ago it was taken, tasks can use the age to decide whether the value is too stale to act on. The first call
+    to value() after startup blocks until the first sample is available.
+
+    If the sample function raises an exception it's logged, and the function called again after a delay which starts
+    at 10ms and doubles with each consecutive failure up to a second.
+
+    Each new sample wakes any task waiting for this resource to change. Sample functions can't have dependencies, as
+    they don't run as part of a tick.
     """
-    if name in RESOURCES:
-        # If this resource was already defined we're going to overwrite it, so shut the existing one down first
-        RESOURCES[name].shutdown()
-    if isinstance(value, types.FunctionType):
-        RESOURCES[name] = SimpleResource(name=name, value_func=value)
-        LOG.info('Registered resource function "%s"', name)
-    elif isinstance(value, Resource):
-        RESOURCES[name] = value
-        LOG.info('Registered resource class "%s"', name)
-    else:
-        def resource_function():
-            return value
 
-        RESOURCES[name] = SimpleResource(name=name, value_func=resource_function)
-        LOG.info('Registered resource value "%s"', name)
+    def __init__(self, name, sample_func, sample_interval=0, startup_func=None, shutdown_func=None,
+                 first_sample_timeout=5.0):
+        """
+        :param name:
+            Name used when referencing this resource
+        :param sample_func:
+            No-argument function called to take each sample
+        :param sample_interval:
+            Seconds to wait between samples, defaults to 0 in which case the function is called again as soon as it
+            returns. The function is assumed to block until a new value is available in this case.
+        :param startup_func:
+            Optional function called on startup, before sampling starts
+        :param shutdown_func:
+            Optional function called on shutdown, after sampling has stopped
+        :param first_sample_timeout:
+            Seconds to wait for the first sample before raising a :class:`~approxeng.task.TaskException`
+        """
+        super(SampledResource, self).__init__(name=name)
+        self.sample_func = sample_func
+        self.sample_interval = sample_interval
+        self.startup_func = startup_func
+        self.shutdown_func = shutdown_func
+        self.first_sample_timeout = first_sample_timeout
+        # Tuple of (value, monotonic timestamp), replaced wholesale by the sampling thread
+        self._latest = None
+        self._first_sample = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
 
+    def startup(self):
+        if self._thread is not None:
+            return
+        if self.startup_func is not None:
+            self.startup_func()
+        self._latest = None
+        self._first_sample.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name='sampler-{}'.format(self.name), daemon=True)
+        self._thread.start()
 
-@task(name='exit')
-def exit_task(error=None):
+    def shutdown(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=self.first_sample_timeout)
+        if self._thread.is_alive():
+            LOG.warning('Sampling thread for resource "%s" did not stop, abandoning it', self.name)
+        self._thread = None
+        if self.shutdown_func is not None:
+            self.shutdown_func()
+
+    def _sample_loop(self):
+        # Delay after a failed sample, doubled for each consecutive failure so a broken device doesn't spin this thread
+        backoff = 0
+        while not self._stop.is_set():
+            try:
+                self._latest = (self.sample_func(), monotonic())
+                self._first_sample.set()
+                self.notify_changed()
+                backoff = 0
+            except Exception:
+                if not backoff:
+                    LOG.exception('Error sampling resource "%s"', self.name)
+                backoff = min(backoff * 2, _MAX_SAMPLE_BACKOFF) if backoff else _MIN_SAMPLE_BACKOFF
+            if self.sample_interval or backoff:
+                self._stop.wait(max(self.sample_interval, backoff))
+
+    def value(self, **kwargs):
+        latest = self._latest
+        if latest is None:
+            if not self._first_sample.wait(timeout=self.first_sample_timeout):
+                raise TaskException('No sample available from resource "{}"'.format(self.name))
+            latest = self._latest
+        sample_value, timestamp = latest
+        return Sample(value=sample_value, age=monotonic() - timestamp)
+
+
+class WatchdogResource(Resource):
     """
-    Exit the loop. If there was an exception raised causing this task to run then wrap the exception in the TaskStop,
-    otherwise it'll be empty.
+    Wraps another resource, calling its value method on a worker thread through a :class:`~approxeng.task.Watchdog`
+    and waiting no longer than value_timeout seconds for it. Use this for hardware reads which can occasionally hang,
+    such as an I2C device holding the bus, so the loop keeps running and check tasks can still stop the robot. Register
+    resources with a value_timeout rather than creating this directly.
+
+    If a read overruns, the fallback value is returned if there is one, otherwise a :class:`~approxeng.task.TaskTimeout`
+    is raised, which passes control to the error task. While an overrunning read is still blocked, later reads overrun
+    immediately rather than waiting.
     """
-    return TaskStop(error)
 
+    def __init__(self, name, resource, value_timeout, timeout_fallback=None):
+        """
+        :param name:
+            Name used when referencing this resource
+        :param resource:
+            The resource to wrap, its value method must be safe to call from another thread
+        :param value_timeout:
+            Seconds to wait for each read
+        :param timeout_fallback:
+            Value returned when a read overruns, or None to raise a TaskTimeout
+        """
+        super(WatchdogResource, self).__init__(name=name, dependencies=list(resource.dependencies))
+        self.resource = resource
+        self.value_timeout = value_timeout
+        self.timeout_fallback = timeout_fallback
+        self.watchdog = Watchdog(name='resource-{}'.format(name))
+        # True from the first overrun until a read succeeds, so the warning is only logged once
+        self._overrunning = False
 
-class TaskStop:
+    def startup(self):
+        self.resource.startup()
+
+    def shutdown(self):
+        self.resource.shutdown()
+
+    def value(self, **kwargs):
+        try:
+            value = self.watchdog.call(self.value_timeout, self.resource.value, kwargs)
+        except TaskTimeout as timeout:
+            return self._overran(timeout)
+        if inspect.isawaitable(value):
+            return self._await_value(value)
+        self._overrunning = False
+        return value
+
+    async def _await_value(self, awaitable):
+        try:
+            value = await _within_budget(awaitable, self.value_timeout, 'resource-' + self.name)
+        except TaskTimeout as timeout:
+            return self._overran(timeout)
+        self._overrunning = False
+        return value
+
+    def _overran(self, timeout):
+        if self.timeout_fallback is None:
+            raise timeout
+        if not self._overrunning:
+            LOG.warning('Resource "%s" overran its %ss budget, using fallback value', self.name, self.value_timeout)
+            self._overrunning = True
+        return self.timeout_fallback
+
+
+class FailurePolicy:
     """
-    Wraps a single value, defaulting to None. If a task returns an instance of this class, the task loop will exit and
-    the return value of the run() function will be the wrapped value. This allows tasks to exit the loop and pass
-    information to the caller as they do so.
+    Describes how a resource handles errors from its value method, pass one when registering a resource to use it. A
+    failed read returns the last good value, marked as stale, and the resource isn't read again until a backoff delay
+    has passed, doubling with each consecutive failure. After max_failures consecutive failures the circuit opens and
+    the resource raises a :class:`~approxeng.task.TaskException`, passing control to the error task. While the circuit
+    is open reads are only retried every reset_timeout seconds, and the first successful read closes it again.
+
+    This keeps the loop running at its normal rate through occasional glitches, such as a dropped packet from a sensor,
+    while still escalating failures which persist.
     """
 
-    def __init__(self, return_value=None):
-        self.return_value = return_value
+    def __init__(self, max_failures=5, backoff=0.05, max_backoff=1.0, reset_timeout=5.0):
+        """
+        :param max_failures:
+            Number of consecutive failures after which the circuit opens
+        :param backoff:
+            Seconds to wait before retrying after the first failure
+        :param max_backoff:
+            Longest time in seconds to wait between retries before the circuit opens
+        :param reset_timeout:
+            Seconds to wait between retries while the circuit is open
+        """
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reset_timeout = reset_timeout
 
 
-def run(root_task, error_task='exit', check_tasks=None, raise_exceptions=False):
-    """
-    Run the task loop!
-
-    :param root_task:
-        The first task to start with
-    :param error_task:
-        The task to switch to if an exception occurs, defaults to the ExitTask to exit the loop. If you have hardware
-        such as motors that you need to ensure is deactivated, the best approach is to have a task that only does
-        hardware shutdown, handles any errors with that process internally, and then delegates to the exit task to
-        stop the task look. Defaults to the exit task if not specified.
-    :param check_tasks:
-        A sequence of functions which will be called before each tick of the selected task. If any of them return
-        then the return value is used instead of calling and using the value of the task's tick. This can be done
-        to handle cases like 'make the home button always jump back to the root task', or 'exit the task loop on
-        low battery conditions' or similar. Don't put too much logic here, it'll get called every tick. Also good for
-        cases where you absolutely want to bail if hardware isn't available (joystick out of range is a particular case)
-    :param raise_exceptions:
-        Defaults to False, if set to True then any exceptions raised by a task will be handled, then wrapped in a
-        TaskException and raised from this call. If False then they will be handled, and control passed to the
-        designated error task.
-    :returns:
-        If the loop exits as the result of a task returning a :class:`~approxeng.task.TaskStop` it will return the
-        value wrapped by that instance, otherwise None.
+class CircuitBreakerResource(Resource):
+    """
+    Wraps another resource, handling errors from its value method as described by a
+    :class:`~approxeng.task.FailurePolicy`. Register resources with a failure_policy rather than creating this directly,
+    whether the value is stale is then available to tasks as a resource with '_stale' appended to the name:
+
+    .. code-block:: python
+
+        from approxeng.task import resource, task, FailurePolicy
+
+        @resource(failure_policy=FailurePolicy(max_failures=10))
+        def heading():
+            return compass.read()
+
+        @task
+        def steer(heading, heading_stale):
+            ...
+
+    If a read fails before there's been a good value there's nothing to fall back on, so the error is raised. The count
+    of consecutive failures is kept when the resource is shut down and started again, so an open circuit stays open.
     """
 
-    def get_task(t):
+    def __init__(self, name, resource, policy):
         """
-        Resolve a task instance
+        :param name:
+            Name used when referencing this resource
+        :param resource:
+            The resource to wrap
+        :param policy:
+            A :class:`~approxeng.task.FailurePolicy`
+        """
+        super(CircuitBreakerResource, self).__init__(name=name, dependencies=list(resource.dependencies))
+        self.resource = resource
+        self.policy = policy
+        # Number of consecutive failed reads
+        self.failures = 0
+        self.last_error = None
+        # True if the most recent value returned was the last good value rather than a new one
+        self.stale = False
+        # Tuple containing the last good value, or None if there isn't one
+        self._last_good = None
+        self._retry_at = 0
 
-        :param t:
-            Either a name, or a Task object
-        :return:
-            The task object, if supplied, or the result of a lookup in the TASKS global otherwise
+    @property
+    def open(self):
         """
-        if isinstance(t, Task):
-            return t
-        return TASKS[t]
-
-    # Start with the root task as the active one
-    active_task = get_task(root_task)
-    # Initialise count to 0
-    # Loop until we're done
-    finished = False
-    return_value = None
-    try:
-        while not finished:
-            try:
-                response = None
-                # If we have any pre-task checks to run do them now. If any of those functions return
-                # non-None values we'll use those in place of the active task. Code these carefully!
-                # Here's where you'd check for e.g. joystick not connected.
-                if check_tasks is not None:
-                    for check_task in check_tasks:
-                        check_response = check_task()
-                        if check_response is not None:
-                            response = check_response
-                # If no check_task functions returned anything, run the actual task tick
-                if response is None:
-                    response = active_task.do_tick()
-                # If the tick function returned a value it means we need to switch control
-                if response is not None:
-                    if isinstance(response, Task) or isinstance(response, str):
-                        # New task, either name or Task object. Shut down and switch to it for the next tick
-                        active_task.do_shutdown()
-                        active_task = get_task(response)
-                    elif isinstance(response, TaskStop):
-                        # TaskStop value returned
-                        active_task.do_shutdown()
-                        finished = True
-                        return_value = response.return_value
-            except Exception as e:
-                # Anything throwing an exception ends up here. Log it first, then delegate to a handler task
-                LOG.exception('Exception raised within task loop')
-                # Shut the active task down, add the exception to the world as 'error' and launch the error task
-                active_task.do_shutdown()
-                if raise_exceptions:
-                    raise TaskException from e
-                register_resource('error', e)
-                active_task = get_task(error_task)
-    except TaskException as te:
-        # Catch and stash the exception in the return value
-        return_value = te
-    finally:
-        # Finished, shut down all resources and exit
-        for res in reversed(get_resource_total_order()):
-            RESOURCES[res].shutdown()
-    # If we're raising exceptions, and there was an exception, raise it.
-    if raise_exceptions and isinstance(return_value, Exception):
-        raise return_value
-    # Otherwise return the return value and exit.
-    return return_value
+        True if the circuit is open, in which case reads raise an exception rather than returning stale values.
+        """
+        return self.failures >= self.policy.max_failures
+
+    def startup(self):
+        self._last_good = None
+        self.stale = False
+        self.resource.startup()
+
+    def shutdown(self):
+        self.resource.shutdown()
+
+    def value(self, **kwargs):
+        if self.failures and monotonic() < self._retry_at:
+            return self._fallback()
+        try:
+            value = self.resource.value(**kwargs)
+        except Exception as e:
+            self._failed(e)
+            return self._fallback()
+        if inspect.isawaitable(value):
+            return self._await_value(value)
+        return self._succeeded(value)
+
+    async def _await_value(self, awaitable):
+        try:
+            value = await awaitable
+        except Exception as e:
+            self._failed(e)
+            return self._fallback()
+        return self._succeeded(value)
+
+    def _succeeded(self, value):
+        if self.failures:
+            LOG.info('Resource "%s" recovered after %i failures', self.name, self.failures)
+            self.failures = 0
+        self.stale = False
+        self._last_good = (value,)
+        return value
+
+    def _failed(self, error):
+        self.failures += 1
+        self.last_error = error
+        policy = self.policy
+        if self.failures < policy.max_failures:
+            LOG.warning('Resource "%s" failed, %i in a row: %r', self.name, self.failures, error)
+            delay = min(policy.backoff * 2 ** (self.failures - 1), policy.max_backoff)
+        else:
+            if self.failures == policy.max_failures:
+                LOG.error('Resource "%s" failed %i times in a row, opening circuit', self.name, self.failures)
+            delay = policy.reset_timeout
+        self._retry_at = monotonic() + delay
+
+    def _fallback(self):
+        if self.open or self._last_good is None:
+            raise TaskException('Resource "{}" unavailable after {} consecutive failures'.format(
+                self.name, self.failures)) from self.last_error
+        self.stale = True
+        return self._last_good[0]
+
+
+class CircuitStaleResource(Resource):
+    """
+    Tells tasks whether the value of a :class:`~approxeng.task.CircuitBreakerResource` is stale, True if it's the last
+    good value because the most recent read failed. Depends on the circuit breaker resource so it always describes the
+    current tick's value.
+    """
+
+    def __init__(self, breaker_resource):
+        super(CircuitStaleResource, self).__init__(name=breaker_resource.name + '_stale',
+                                                   dependencies=[breaker_resource.name])
+        self.breaker_resource = breaker_resource
+
+    def startup(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def value(self, **kwargs):
+        return self.breaker_resource.stale
+
+
+class CachedResource(Resource):
+    """
+    Wraps another resource, only calling its value method when the previous value is more than max_age seconds old
+    and otherwise returning the previous value. Use this for things which change slowly but are relatively expensive to
+    read, such as battery voltage read over I2C. Register resources with a max_age rather than creating this directly,
+    the age of the value is then also available to tasks as a resource with '_age' appended to the name:
+
+    .. code-block:: python
+
+        from approxeng.task import resource, task
+
+        @resource(max_age=5)
+        def battery_voltage():
+            return read_battery_voltage()
+
+        @task
+        def drive(battery_voltage, battery_voltage_age):
+            ...
+
+    The value is only computed once per tick no matter how many tasks and resources use it, so everything in a tick
+    sees the same value. Any dependencies are still evaluated every tick, give them a max_age as well if they're
+    expensive. The cached value is discarded when the resource is started.
+    """
+
+    def __init__(self, name, resource, max_age):
+        """
+        :param name:
+            Name used when referencing this resource
+        :param resource:
+            The resource whose value should be cached
+        :param max_age:
+            Seconds to keep using a value before reading it again
+        """
+        super(CachedResource, self).__init__(name=name, dependencies=list(resource.dependencies))
+        self.resource = resource
+        self.max_age = max_age
+        # Tuple of (value, monotonic timestamp), or None if there's no value yet
+        self._cached = None
+
+    @property
+    def age(self):
+        """
+        Seconds since the current value was read, or None if it hasn't been read yet.
+        """
+        cached = self._cached
+        return None if cached is None else monotonic() - cached[1]
+
+    def startup(self):
+        self._cached = None
+        self.resource.startup()
+
+    def shutdown(self):
+        self.resource.shutdown()
+
+    def value(self, **kwargs):
+        cached = self._cached
+        if cached is not None and monotonic() - cached[1] < self.max_age:
+            return cached[0]
+        value = self.resource.value(**kwargs)
+        if inspect.isawaitable(value):
+            return self._cache_async(value)
+        self._cached = (value, monotonic())
+        return value
+
+    async def _cache_async(self, awaitable):
+        value = await awaitable
+        self._cached = (value, monotonic())
+        return value
+
+
+class CachedAgeResource(Resource):
+    """
+    Provides the age in seconds of the value of a :class:`~approxeng.task.CachedResource` to tasks. Depends on the
+    cached resource so the age is always that of the current tick's value.
+    """
+
+    def __init__(self, cached_resource):
+        super(CachedAgeResource, self).__init__(name=cached_resource.name + '_age', dependencies=[cached_resource.name])
+        self.cached_resource = cached_resource
+
+    def startup(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def value(self, **kwargs):
+        return self.cached_resource.age
+
+
+class PureResource(Resource):
+    """
+    Wraps a resource whose value depends only on the values of its dependencies, only calling its value method when
+    at least one of them has changed since the previous call and otherwise returning the previous value. Use this for
+    expensive derived values, such as a path planned from a map, which would otherwise be recomputed every tick.
+    Register resources with pure set to True rather than creating this directly.
+
+    Dependency values are unchanged if they're the same object as last time, or compare equal to it. Values which can't
+    be compared, such as numpy arrays, count as changed unless they're the same object. As the previous values are kept
+    by reference, dependencies must return a new value when they change rather than modifying the old one in place.
+
+    Because an unchanged result is the same object as before, anything downstream which is also pure is skipped as
+    well, so a change only propagates as far as it actually makes a difference.
+    """
+
+    def __init__(self, name, resource):
+        """
+        :param name:
+            Name used when referencing this resource
+        :param resource:
+            The resource to wrap, its value method must have no side effects
+        """
+        super(PureResource, self).__init__(name=name, dependencies=list(resource.dependencies))
+        self.resource = resource
+        self.pure = True
+        # Tuple of (dependency values, value), or None if there's no value yet
+        self._previous = None
+
+    def startup(self):
+        self._previous = None
+        self.resource.startup()
+
+    def shutdown(self):
+        self.resource.shutdown()
+
+    def value(self, **kwargs):
+        previous = self._previous
+        if previous is not None and _unchanged(previous[0], kwargs):
+            return previous[1]
+        value = self.resource.value(**kwargs)
+        if inspect.isawaitable(value):
+            return self._remember_async(kwargs, value)
+        self._previous = (kwargs, value)
+        return value
+
+    async def _remember_async(self, kwargs, awaitable):
+        value = await awaitable
+        self._previous = (kwargs, value)
+        return value
+
+
+def _unchanged(previous, current):
+    """
+    Compare two dicts of dependency values, as passed to a resource's value method.
+    """
+    for name, value in current.items():
+        old_value = previous[name]
+        if old_value is value:
+            continue
+        try:
+            if not bool(old_value == value):
+                return False
+        except Exception:
+            return False
+    return True
+
+
+def register_resource(name, value, background=False, sample_interval=0, process=False, history=None, max_age=None,
+                      pure=False, value_timeout=None, timeout_fallback=None, failure_policy=None):
+    """
+    Explicitly register a value as a resource with the default task loop, see
+    :meth:`~approxeng.task.TaskLoop.register_resource`.
+    """
+    DEFAULT_LOOP.register_resource(name=name, value=value, background=background, sample_interval=sample_interval,
+                                   process=process, history=history, max_age=max_age, pure=pure,
+                                   value_timeout=value_timeout, timeout_fallback=timeout_fallback,
+                                   failure_policy=failure_policy)
+
+
+def exit_task(error=None):
+    """
+    Exit the loop. If there was an exception raised causing this task to run then wrap the exception in the TaskStop,
+    otherwise it'll be empty. Every task loop registers this as 'exit'.
+    """
+    return TaskStop(error)
+
+
+class ResourceManager:
+    """
+    Reference counts resources used by tasks and check tasks in the task loop. A resource is started when it gains its
+    first user, and kept running as long as anything is using it, so control can pass between tasks sharing a resource
+    without it being shut down and started up again. Resources with no users are shut down by
+    :meth:`~approxeng.task.ResourceManager.collect` once they've been idle for the grace period. Only resources which
+    this manager actually started are ever shut down.
+
+    If concurrent is True, resources are started level by level through the dependency graph, with all the resources
+    in a level, which don't depend on each other, started at the same time on separate threads. Shutdown works the
+    same way in reverse. If a timeout is set, any resource taking longer than that to start raises a
+    :class:`~approxeng.task.TaskException`, and any taking longer to shut down is abandoned with a warning, so a hung
+    device can't stop the loop from exiting. A startup which times out is tracked until it finishes, until then the
+    resource can't be started again, and if it did start it's treated as running with no users. The time taken to
+    start and stop each resource is kept in the timings dict, and recorded in the profiler if there is one.
+    """
+
+    def __init__(self, grace_period=0, loop=None, concurrent=False, timeout=None, profiler=None):
+        """
+        :param grace_period:
+            Seconds a resource must have been unused before collect will shut it down, or None to keep all resources
+            running until shutdown_all is called.
+        :param loop:
+            The :class:`~approxeng.task.TaskLoop` whose resources are managed, defaults to the default loop
+        :param concurrent:
+            If True, start and stop independent resources at the same time. Resource startup and shutdown methods must
+            be safe to call from a background thread if you use this.
+        :param timeout:
+            Optional time limit in seconds for each resource's startup or shutdown
+        :param profiler:
+            Optional :class:`~approxeng.task.profiling.Profiler`, if supplied startup and shutdown times for each
+            resource are recorded in the 'resource_startup' and 'resource_shutdown' categories.
+        """
+        self.grace_period = grace_period
+        self.loop = DEFAULT_LOOP if loop is None else loop
+        self.concurrent = concurrent
+        self.timeout = timeout
+        self.profiler = profiler
+        # Name -> number of users
+        self.users = {}
+        # Name -> resource instance, for all resources this manager has started and not yet shut down
+        self.running = {}
+        # Name -> monotonic time at which the resource lost its last user
+        self.idle_since = {}
+        # Name -> (resource instance, event set once its startup has finished), for resources being started
+        self.starting = {}
+        # Name -> (resource instance, thread, outcomes dict), for startups which timed out but may still be running
+        self.abandoned = {}
+        # Phase, either 'startup' or 'shutdown' -> name -> seconds taken the last time
+        self.timings = {'startup': {}, 'shutdown': {}}
+        # Resources may be acquired from a background thread when pre-warming tasks
+        self._lock = threading.RLock()
+
+    def acquire(self, names):
+        """
+        Register a new user of each of the named resources, starting any which aren't already running. If any fail to
+        start, no users are registered and the exception is raised once the others have finished starting.
+
+        Resources are started without holding the manager's lock, so one thread starting slow resources doesn't hold
+        up another which only needs resources that are already running. If a resource is already being started by
+        another thread, this waits for that to finish rather than starting it again.
+
+        :param names:
+            Resource names, in dependency order as returned by :func:`~approxeng.task.get_resource_total_order`
+        """
+        resources = self.loop.resources
+        while True:
+            with self._lock:
+                self._reap_abandoned()
+                for name in names:
+                    if name in self.abandoned:
+                        raise TaskException('Resource "{}" is still starting after timing out'.format(name))
+                # Wait for anything another thread is starting, it may fail in which case we'll start it ourselves
+                in_progress = [self.starting[name][1] for name in names
+                               if name in self.starting and self.starting[name][0] is resources[name]]
+                if not in_progress:
+                    # Either not running, or the resource was replaced by a call to register_resource since it started
+                    to_start = {name: resources[name] for name in names
+                                if self.running.get(name) is not resources[name]}
+                    done = threading.Event()
+                    for name, res in to_start.items():
+                        self.starting[name] = (res, done)
+                    break
+            for event in in_progress:
+                event.wait()
+        started, error = {}, None
+        try:
+            if to_start:
+                started, error = self._run_phase('startup', to_start)
+        finally:
+            with self._lock:
+                for name in to_start:
+                    self.starting.pop(name, None)
+                self.running.update(started)
+                done.set()
+                if error is None:
+                    for name in names:
+                        self.users[name] = self.users.get(name, 0) + 1
+                        self.idle_since.pop(name, None)
+                else:
+                    # Leave anything which did start to be collected
+                    now = monotonic()
+                    for name in started:
+                        if name not in self.users:
+                            self.idle_since[name] = now
+        if error is not None:
+            raise error
+
+    def release(self, names):
+        """
+        Remove a user from each of the named resources. Resources left with no users aren't shut down immediately,
+        this happens when collect is called.
+
+        :param names:
+            Resource names, as passed to a previous call to acquire
+        """
+        now = monotonic()
+        with self._lock:
+            for name in names:
+                count = self.users.get(name, 0) - 1
+                if count <= 0:
+                    self.users.pop(name, None)
+                    if name in self.running:
+                        self.idle_since[name] = now
+                else:
+                    self.users[name] = count
+
+    def collect(self):
+        """
+        Shut down any resources which have had no users for at least the grace period.
+        """
+        if self.grace_period is None or not (self.idle_since or self.abandoned):
+            return
+        now = monotonic()
+        with self._lock:
+            self._reap_abandoned()
+            expired = [name for name, since in self.idle_since.items()
+                       if now - since >= self.grace_period and name not in self.starting]
+            if expired:
+                self._shutdown(expired)
+
+    def shutdown_all(self, keep=None):
+        """
+        Shut down all running resources, called when the task loop exits.
+
+        :param keep:
+            Optional names of resources to leave running, because something may still be using them
+        """
+        keep = set() if keep is None else set(keep)
+        with self._lock:
+            self._reap_abandoned()
+            for name in self.abandoned:
+                LOG.warning('Resource "%s" is still starting after timing out, unable to shut it down', name)
+            self._shutdown([name for name in self.running if name not in keep])
+            self.users.clear()
+            if self.timings['startup']:
+                LOG.info('Resource timings (ms):\n%s', self.report())
+
+    def report(self):
+        """
+        :return:
+            A human readable table of the most recent startup and shutdown time for each resource, in milliseconds
+        """
+        lines = ['{:<30} {:>9} {:>9}'.format('resource', 'startup', 'shutdown')]
+        startup = self.timings['startup']
+        shutdown = self.timings['shutdown']
+        for name in sorted(set(startup) | set(shutdown)):
+            millis = ['{:.3f}'.format(phase[name] * 1000) if name in phase else '-' for phase in [startup, shutdown]]
+            lines.append('{:<30} {:>9} {:>9}'.format(name, *millis))
+        return '\n'.join(lines)
+
+    def _reap_abandoned(self):
+        """
+        Check on startups which timed out, any which have since succeeded are treated as running with no users, so they
+        will be shut down by collect or shutdown_all. Must be called with the lock held.
+        """
+        now = monotonic()
+        for name, (res, thread, outcomes) in list(self.abandoned.items()):
+            if thread.is_alive():
+                continue
+            del self.abandoned[name]
+            if name in outcomes and outcomes[name] is None:
+                LOG.info('Resource "%s" finished starting after timing out', name)
+                self.running[name] = res
+                if name not in self.users:
+                    self.idle_since[name] = now
+
+    def _shutdown(self, names):
+        to_stop = {}
+        for name in names:
+            self.idle_since.pop(name, None)
+            res = self.running.pop(name, None)
+            if res is not None:
+                to_stop[name] = res
+        if to_stop:
+            self._run_phase('shutdown', to_stop)
+
+    def _run_phase(self, phase, resources):
+        """
+        Start up or shut down a set of resources, respecting dependencies between them.
+
+        :param phase:
+            Either 'startup' or 'shutdown'
+        :param resources:
+            Dict of name to resource
+        :return:
+            A tuple of dict of name to resource for those which succeeded, and the first exception raised, or None
+        """
+        succeeded = {}
+        error = None
+        for level in _dependency_levels(resources, reverse=phase == 'shutdown'):
+            if not self.concurrent and self.timeout is None:
+                # Simple case, call each one directly
+                for name in level:
+                    try:
+                        self._call(phase, name, resources[name])
+                        succeeded[name] = resources[name]
+                    except Exception as e:
+                        if phase == 'startup':
+                            error = e
+                            break
+                        LOG.exception('Error shutting down resource "%s"', name)
+            else:
+                outcomes = self._run_level(phase, level, resources)
+                for name in level:
+                    outcome = outcomes[name]
+                    if outcome is None:
+                        succeeded[name] = resources[name]
+                    elif phase == 'startup':
+                        error = error or outcome
+                    else:
+                        LOG.warning('Unable to shut down resource "%s": %s', name, outcome)
+            if error is not None:
+                # Don't start anything which depends on a resource which didn't start
+                break
+        return succeeded, error
+
+    def _run_level(self, phase, level, resources):
+        """
+        Start or stop all resources in a level on separate threads, waiting up to the timeout for each.
+
+        :return:
+            Dict of name to None if the call succeeded, or the exception it raised, or a TaskException if it timed out
+        """
+        if self.concurrent:
+            return self._run_threads(phase, level, resources)
+        # Still need a thread per call to enforce the timeout, but only run one at a time
+        outcomes = {}
+        for name in level:
+            outcomes.update(self._run_threads(phase, [name], resources))
+        return outcomes
+
+    def _run_threads(self, phase, names, resources):
+        outcomes = {}
+
+        def run(name):
+            try:
+                self._call(phase, name, resources[name])
+                outcomes[name] = None
+            except Exception as e:
+                outcomes[name] = e
+
+        threads = {name: threading.Thread(target=run, args=(name,), name='{}-{}'.format(phase, name), daemon=True)
+                   for name in names}
+        for thread in threads.values():
+            thread.start()
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        for thread in threads.values():
+            thread.join(None if deadline is None else max(0.0, deadline - monotonic()))
+        # The threads carry on writing to outcomes if they finish later, so return a copy
+        result = dict(outcomes)
+        for name in names:
+            if name not in result:
+                result[name] = TaskException('Resource "{}" {} timed out after {}s'.format(name, phase, self.timeout))
+                if phase == 'startup':
+                    with self._lock:
+                        self.abandoned[name] = (resources[name], threads[name], outcomes)
+        return result
+
+    def _call(self, phase, name, res):
+        start = perf_counter()
+        try:
+            if phase == 'startup':
+                res.startup()
+            else:
+                res.shutdown()
+        finally:
+            elapsed = perf_counter() - start
+            self.timings[phase][name] = elapsed
+            if self.profiler is not None:
+                self.profiler.record('resource_' + phase, name, elapsed)
+
+
+def _dependency_levels(resources, reverse=False):
+    """
+    Group resources into levels, such that every resource only depends on resources in earlier levels. Dependencies on
+    resources which aren't in the dict are ignored.
+
+    :param resources:
+        Dict of name to resource
+    :param reverse:
+        If True, return the levels in reverse, for shutting resources down
+    :return:
+        List of lists of names
+    """
+    levels = {}
+
+    def level_of(name):
+        if name not in levels:
+            # Mark as level 0 while visiting, cycles are caught when resolving the resource order
+            levels[name] = 0
+            levels[name] = max([level_of(dep_name) + 1 for dep_name in resources[name].dependencies
+                                if dep_name in resources] + [0])
+        return levels[name]
+
+    grouped = {}
+    for name in resources:
+        grouped.setdefault(level_of(name), []).append(name)
+    ordered = [grouped[level] for level in sorted(grouped)]
+    return list(reversed(ordered)) if reverse else ordered
+
+
+class Prewarmer:
+    """
+    Warms up the likely successors of the active task on a background thread, so that when control passes to one of
+    them its resources are already running and any expensive preparation has been done. Resources are held through the
+    :class:`~approxeng.task.ResourceManager` on behalf of the successors until the next task becomes active, at which
+    point the holds are released and that task's successors are warmed instead.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._held = []
+        self._thread = None
+
+    def warm(self, active_task):
+        """
+        Start warming the successors of a newly active task, releasing anything held for the previous one once the
+        new successors have been acquired, so resources shared between the two sets aren't bounced. This never waits
+        for a warm up already in progress, the new warm up waits for it in the background instead.
+        """
+        previous_thread = self._thread
+        previous = self._held
+        self._held = []
+        successors = []
+        for successor in active_task.successors():
+            if not isinstance(successor, Task):
+                successor = self.manager.loop.tasks.get(successor)
+            if successor is not None and successor is not active_task and successor not in successors:
+                successors.append(successor)
+        self._thread = threading.Thread(target=self._warm, args=(successors, previous_thread, previous, self._held),
+                                        name='prewarm-{}'.format(active_task.name), daemon=True)
+        self._thread.start()
+
+    def _warm(self, successors, previous_thread, previous, held):
+        if previous_thread is not None:
+            # Previous holds are only complete once its warm up has finished
+            previous_thread.join()
+        for successor in successors:
+            try:
+                names = self.manager.loop.get_resource_total_order(successor.resources)
+                self.manager.acquire(names)
+                held.append(names)
+                successor.prepare()
+                LOG.debug('Pre-warmed task "%s"', successor.name)
+            except Exception:
+                LOG.exception('Unable to pre-warm task "%s"', successor.name)
+        for names in previous:
+            self.manager.release(names)
+
+    def wait(self):
+        """
+        Wait for any warm up in progress, and any it's waiting for, to finish.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stop(self):
+        """
+        Wait for any warm up in progress, then release all held resources.
+        """
+        self.wait()
+        for names in self._held:
+            self.manager.release(names)
+        self._held = []
+
+
+class TickLogger:
+    """
+    Per-tick logging for the task loop. Rather than calling the logger on every tick, and having it check whether the
+    level is enabled each time, the loop asks this object for a log function whenever a task starts. If the level isn't
+    enabled at that point it gets None back and doesn't log anything, so disabled tick logging costs nothing. When it
+    is enabled, messages can be sampled and rate limited to avoid flooding log handlers, and carry the task name and
+    counts as extra attributes on the log record for structured log handlers.
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG, sample_every=1, max_per_second=None):
+        """
+        :param logger:
+            Logger to use, defaults to the 'approxeng.task' logger
+        :param level:
+            Level at which to log ticks, defaults to DEBUG
+        :param sample_every:
+            Only log every n-th tick
+        :param max_per_second:
+            If specified, log at most this many ticks per second, any in excess are counted and the count included in
+            the next message which is logged
+        """
+        self.logger = logger if logger is not None else LOG
+        self.level = level
+        self.sample_every = sample_every
+        self.min_interval = 1.0 / max_per_second if max_per_second else None
+        self._count = 0
+        self._suppressed = 0
+        self._last = None
+
+    def bind(self):
+        """
+        :return:
+            A function taking a task and the loop's global count, which logs a tick of that task, or None if the logger
+            isn't enabled at this level
+        """
+        if not self.logger.isEnabledFor(self.level):
+            return None
+        if self.sample_every <= 1 and self.min_interval is None:
+            return self._log
+        return self._log_sampled
+
+    def _log(self, active_task, global_count, suppressed=0):
+        self.logger.log(self.level, 'Task "%s", task_tick %i, global_tick %i, suppressed %i',
+                        active_task.name, active_task.task_count, global_count, suppressed,
+                        extra={'task': active_task.name, 'task_count': active_task.task_count,
+                               'global_count': global_count})
+
+    def _log_sampled(self, active_task, global_count):
+        self._count += 1
+        if self._count < self.sample_every:
+            return
+        self._count = 0
+        if self.min_interval is not None:
+            now = monotonic()
+            if self._last is not None and now - self._last < self.min_interval:
+                self._suppressed += 1
+                return
+            self._last = now
+        self._log(active_task, global_count, suppressed=self._suppressed)
+        self._suppressed = 0
+
+
+class TickScheduler:
+    """
+    Paces the task loop to a target tick rate. Ticks are scheduled against the monotonic clock, so time spent in the
+    tick itself comes out of the budget for that tick rather than being added to it, and the loop sleeps only for
+    whatever is left. If a tick overruns, the next one starts immediately and the overrun is recorded. If the loop
+    falls more than a whole tick behind the schedule is reset rather than trying to catch up with a burst of ticks.
+
+    Pass an instance to :func:`~approxeng.task.run` if you want to inspect the timing information after, or during,
+    the run, otherwise one will be created for you.
+    """
+
+    #: If False the loop never sleeps waiting for a change to a task's wake_on resources, as nothing is running in real
+    #: time to make one
+    waits_for_changes = True
+
+    def __init__(self, tick_rate=None, history=100):
+        """
+        :param tick_rate:
+            Default target rate in ticks per second, or None to run as fast as possible
+        :param history:
+            Number of recent lateness values to keep
+        """
+        self.tick_rate = tick_rate
+        self.ticks = 0
+        self.overruns = 0
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        self.recent_lateness = deque(maxlen=history)
+        self._deadline = None
+        self._period = None
+
+    def reset(self):
+        """
+        Forget the current schedule, the next tick will start immediately and become the new reference point.
+        """
+        self._deadline = None
+
+    def wait(self, tick_rate=None):
+        """
+        Wait until the next tick is due. Call this at the start of each tick.
+
+        :param tick_rate:
+            Rate for this tick, overriding the default. If this differs from the rate used for the previous tick the
+            schedule is reset.
+        :return:
+            How late, in seconds, this tick started relative to its deadline
+        """
+        remaining = self._begin_tick(tick_rate)
+        if remaining is not None and remaining > 0:
+            sleep(remaining)
+        return self._end_tick(remaining)
+
+    async def wait_async(self, tick_rate=None):
+        """
+        Asynchronous version of :meth:`~approxeng.task.TickScheduler.wait`. Always yields to the event loop, even if
+        the next tick is already due.
+        """
+        remaining = self._begin_tick(tick_rate)
+        await asyncio.sleep(remaining if remaining is not None and remaining > 0 else 0)
+        return self._end_tick(remaining)
+
+    def _begin_tick(self, tick_rate):
+        """
+        Work out how long to wait until the next tick, or None if the loop isn't paced.
+        """
+        if tick_rate is None:
+            tick_rate = self.tick_rate
+        self.ticks += 1
+        if tick_rate is None:
+            self._deadline = None
+            self._period = None
+            return None
+        period = 1.0 / tick_rate
+        if period != self._period:
+            self._period = period
+            self._deadline = None
+        now = monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        return self._deadline - now
+
+    def _end_tick(self, remaining):
+        """
+        Record how late the tick started, and move on the deadline for the next one.
+        """
+        if remaining is None:
+            return 0.0
+        now = monotonic()
+        if remaining > 0:
+            # Not an overrun, but sleep can wake up a little late, so measure that too
+            lateness = max(0.0, now - self._deadline)
+        else:
+            lateness = -remaining
+            if lateness > 0:
+                self.overruns += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness > self._period:
+            # Too far behind, restart the schedule from now rather than bursting to catch up
+            self._deadline = now + self._period
+        else:
+            self._deadline += self._period
+        self.lateness = lateness
+        self.recent_lateness.append(lateness)
+        return lateness
+
+
+class UnpacedScheduler(TickScheduler):
+    """
+    Scheduler which never waits, even if the active task asks for a tick rate. Used to run simulations and replays as
+    fast as possible. Tasks with wake_on set tick on every tick, rather than waiting for a change.
+    """
+
+    waits_for_changes = False
+
+    def wait(self, tick_rate=None):
+        self.ticks += 1
+        return 0.0
+
+
+class TaskStop:
+    """
+    Wraps a single value, defaulting to None. If a task returns an instance of this class, the task loop will exit and
+    the return value of the run() function will be the wrapped value. This allows tasks to exit the loop and pass
+    information to the caller as they do so.
+    """
+
+    def __init__(self, return_value=None):
+        self.return_value = return_value
+
+
+def _timed(profiler, category, name, func, *args, **kwargs):
+    """
+    Call a function, recording the time it took in the profiler if there is one.
+    """
+    if profiler is None:
+        return func(*args, **kwargs)
+    return profiler.time(category, name, func, *args, **kwargs)
+
+
+def _watched_tick(task, cache):
+    """
+    Tick a task with a tick_timeout through its watchdog. The tick gets its own copy of the cache, so if it overruns
+    it can't write values into later ticks, and the tick counts are only advanced on this thread once it has finished.
+    """
+    private_cache = ResourceCache(executor=cache.executor, profiler=cache.profiler, resources=cache.resources)
+    private_cache.values.update(cache.values)
+    response = task.watchdog.call(task.tick_timeout, task.do_tick, {'cache': private_cache, 'count': False})
+    cache.values.update(private_cache.values)
+    loop = task._get_loop()
+    loop.global_count = loop.global_count + 1
+    task.task_count = task.task_count + 1
+    return response
+
+
+async def _within_budget(awaitable, timeout, name):
+    """
+    Await something, raising a :class:`~approxeng.task.TaskTimeout` if it takes longer than timeout seconds. Unlike a
+    :class:`~approxeng.task.Watchdog` this can't help if the awaitable blocks the event loop.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TaskTimeout('"{}" did not finish within {}s'.format(name, timeout))
+
+
+# Longest time a waiting task sleeps if there's a check task with no resources and the loop has no tick rate
+_CHECK_POLL_PERIOD = 0.1
+
+
+def _check_poll_period(checks, scheduler):
+    """
+    Check tasks with no resources can't be woken by a change, so if there are any, tasks waiting for changes must
+    still wake up regularly for the checks to run.
+
+    :return:
+        The longest time a waiting task may sleep, one tick at the loop's tick rate if it has one, or None if all the
+        checks use resources
+    """
+    if all(check.ordered_resources for check in checks):
+        return None
+    return 1.0 / scheduler.tick_rate if scheduler.tick_rate else _CHECK_POLL_PERIOD
+
+
+def _wake_timeout(task, poll_period):
+    """
+    Longest time to wait for a change before ticking a task, taking into account any check tasks which need polling.
+    """
+    if poll_period is None:
+        return task.wake_timeout
+    if task.wake_timeout is None:
+        return poll_period
+    return min(task.wake_timeout, poll_period)
+
+
+def _start_check_tasks(checks, manager):
+    """
+    Compile each check task and acquire any resources they need, these are held for the lifetime of the loop.
+
+    :return:
+        Set of the names of all resources used by the checks
+    """
+    names = set()
+    for check in checks:
+        check.compile(manager.loop)
+        manager.acquire(check.ordered_resources)
+        names.update(check.ordered_resources)
+    return frozenset(names)
+
+
+class TaskLoop:
+    """
+    A task loop, along with the tasks and resources registered with it and its global tick count. Each loop is
+    independent of any others, so several can be run in the same process, for example to step many simulated robots
+    side by side, or created in worker processes to spread simulations across processors.
+
+    The module level :func:`~approxeng.task.task` and :func:`~approxeng.task.resource` decorators, and functions such
+    as :func:`~approxeng.task.register_resource` and :func:`~approxeng.task.run`, use a default loop created when the
+    module is loaded, which is all most robots need. To use a separate loop, register tasks and resources with its
+    methods instead:
+
+    .. code-block:: python
+
+        from approxeng.task import TaskLoop, TaskStop
+
+        loop = TaskLoop()
+
+        @loop.resource
+        def speed():
+            return 1.5
+
+        @loop.task
+        def drive(speed, task_count):
+            if task_count > 100:
+                return TaskStop(speed)
+
+        loop.run('drive')
+    """
+
+    def __init__(self):
+        # Name -> Task
+        self.tasks = {}
+        # Name -> Resource
+        self.resources = {}
+        # Incremented after every tick of any task in this loop
+        self.global_count = 0
+        # Cached results of get_resource_total_order, keyed by frozenset of requested names, or None for all resources
+        self._order_cache = {}
+        # Incremented whenever resources are registered, so tick plans bound to replaced resources can be recompiled
+        self.resource_version = 0
+        # Names of resources which have reported a change since the last time a task waited for one
+        self._changed = set()
+        self._wakeup = threading.Condition()
+        self.register_task(name='exit', value=exit_task)
+
+    def task(self, _func=None, *, name=None, tick_rate=None, process=False, wake_on=None, wake_timeout=None,
+             tick_timeout=None):
+        """
+        Decorator to indicate that a function is a simple task in this loop, takes the same arguments as the module
+        level :func:`~approxeng.task.task` decorator.
+        """
+        if _func is not None:
+            # Called with no name argument
+            self.register_task(name=_func.__name__, value=_func)
+            return _func
+        else:
+            # Called with an explicit argument, use this to register it
+            def decorator(func):
+                task_name = name if name is not None else func.__name__
+                self.register_task(name=task_name, value=func, tick_rate=tick_rate, process=process, wake_on=wake_on,
+                                   wake_timeout=wake_timeout, tick_timeout=tick_timeout)
+                return func
+
+            return decorator
+
+    def resource(self, _func=None, *, name=None, background=False, sample_interval=0, process=False, history=None,
+                 max_age=None, pure=False, value_timeout=None, timeout_fallback=None, failure_policy=None):
+        """
+        Decorator to indicate that a function produces a resource in this loop, takes the same arguments as the module
+        level :func:`~approxeng.task.resource` decorator.
+        """
+        if _func is not None:
+            # Called with no name argument
+            self.register_resource(_func.__name__, _func)
+            return _func
+        else:
+            # Called with an explicit name argument, use this to register it
+            def decorator(func):
+                resource_name = name if name is not None else func.__name__
+                self.register_resource(resource_name, func, background=background, sample_interval=sample_interval,
+                                       process=process, history=history, max_age=max_age, pure=pure,
+                                       value_timeout=value_timeout, timeout_fallback=timeout_fallback,
+                                       failure_policy=failure_policy)
+                return func
+
+            return decorator
+
+    def register_task(self, name, value, tick_rate=None, process=False, wake_on=None, wake_timeout=None,
+                      tick_timeout=None):
+        """
+        Explicitly register a task, either from a function or from an instance of Task
+
+        :param name:
+            Name used to reference the task
+        :param value:
+            Either a task function, in which case this behaves as if the function were annotated with @task, or a
+            Task object. You may want to use the latter, more verbose, form if extensive setup or custom state handling
+            is needed by your task, although in general most of such handling should be done with resources and tasks
+            themselves should remain largely state free. A Task object should only be registered with one loop.
+        :param tick_rate:
+            Target tick rate for a task function, ignored if value is a Task, in which case set it on the task
+            directly.
+        :param process:
+            If True, and value is a task function, call it in a separate worker process. Ignored for Task objects.
+        :param wake_on:
+            Resources which must change before a task function ticks again, ignored for Task objects
+        :param wake_timeout:
+            Longest time in seconds to wait for a change if wake_on is set, ignored for Task objects
+        :param tick_timeout:
+            Time budget in seconds for each tick of a task function, ignored for Task objects
+        """
+        if isinstance(value, types.FunctionType) and process:
+            from approxeng.task.process import ProcessTask
+            value = ProcessTask(name=name, task_function=value, tick_rate=tick_rate, wake_on=wake_on,
+                                wake_timeout=wake_timeout, tick_timeout=tick_timeout)
+            kind = 'process task function'
+        elif isinstance(value, types.FunctionType):
+            value = SimpleTask(name=name, task_function=value, tick_rate=tick_rate, wake_on=wake_on,
+                               wake_timeout=wake_timeout, tick_timeout=tick_timeout)
+            kind = 'task function'
+        elif isinstance(value, Task):
+            kind = 'task class'
+        else:
+            return
+        # Set the loop before logging, a ParallelTask needs it to find the resources of its children
+        value.loop = self
+        LOG.info('Registered %s "%s", required resources: %s', kind, name, value.resources)
+        self.tasks[name] = value
+
+    def register_resource(self, name, value, background=False, sample_interval=0, process=False, history=None,
+                          max_age=None, pure=False, value_timeout=None, timeout_fallback=None, failure_policy=None):
+        """
+        Explicitly register a value as a resource. If the value is a function then wrap it up as the value() method of a
+        resource class instance. If it is already a resource class instance just register it. If it's a plain static
+        value then wrap it in a function that always returns that value, then wrap that up in the simple class.
+
+        If the value is a function, and background is True, the function is instead wrapped in a
+        :class:`~approxeng.task.SampledResource`, called repeatedly on a background thread with sample_interval seconds
+        between calls, and tasks see the most recent :class:`~approxeng.task.Sample`. If process is True the function is
+        wrapped in a :class:`~approxeng.task.process.ProcessResource` and called in a separate worker process.
+
+        If history is set to a number of values, the most recent values of the resource are kept in a ring buffer and
+        made available to tasks as a resource with '_history' appended to the name, see
+        :class:`~approxeng.task.history.HistoryResource`. This requires numpy. Only values which are actually read are
+        recorded, so a value reused because of max_age or pure, or a last good value used after a failure, is not
+        recorded again.
+
+        If max_age is set, or the value is a resource with its own max_age, each value is reused until it's more than
+        max_age seconds old, and tasks can read its age through a resource with '_age' appended to the name, see
+        :class:`~approxeng.task.CachedResource`.
+
+        If pure is True, or the value is a resource with pure set, the value is only recomputed when the values of its
+        dependencies change, see :class:`~approxeng.task.PureResource`.
+
+        If value_timeout is set, or the value is a resource with its own value_timeout, each read is given that many
+        seconds to finish before timeout_fallback is used instead, or a :class:`~approxeng.task.TaskTimeout` raised if
+        there's no fallback, see :class:`~approxeng.task.WatchdogResource`.
+
+        If failure_policy is set, or the value is a resource with its own failure_policy, errors from the value method
+        are handled as described by the :class:`~approxeng.task.FailurePolicy`, and tasks can tell whether they're
+        seeing the last good value through a resource with '_stale' appended to the name.
+        """
+        if name in self.resources:
+            # If this resource was already defined we're going to overwrite it, so shut the existing one down first
+            self.resources[name].shutdown()
+        # Dependencies may have changed, so any previously computed orderings are no longer valid
+        self.clear_resource_order_cache()
+        if isinstance(value, types.FunctionType) and background:
+            self.resources[name] = SampledResource(name=name, sample_func=value, sample_interval=sample_interval)
+            LOG.info('Registered background resource function "%s"', name)
+        elif isinstance(value, types.FunctionType) and process:
+            from approxeng.task.process import ProcessResource
+            self.resources[name] = ProcessResource(name=name, value_func=value)
+            LOG.info('Registered process resource function "%s"', name)
+        elif isinstance(value, types.FunctionType):
+            self.resources[name] = SimpleResource(name=name, value_func=value)
+            LOG.info('Registered resource function "%s"', name)
+        elif isinstance(value, Resource):
+            self.resources[name] = value
+            LOG.info('Registered resource class "%s"', name)
+        else:
+            def resource_function():
+                return value
+
+            self.resources[name] = SimpleResource(name=name, value_func=resource_function)
+            LOG.info('Registered resource value "%s"', name)
+        res = self.resources[name]
+        res.loop = self
+        # Read any options declared by the resource itself before it's wrapped, as the wrappers don't have them
+        if value_timeout is None:
+            value_timeout = getattr(res, 'value_timeout', None)
+            timeout_fallback = getattr(res, 'timeout_fallback', None)
+        if failure_policy is None:
+            failure_policy = getattr(res, 'failure_policy', None)
+        pure = pure or getattr(res, 'pure', False)
+        if max_age is None:
+            max_age = getattr(res, 'max_age', None)
+        if value_timeout is not None and not isinstance(res, WatchdogResource):
+            self.resources[name] = WatchdogResource(name=name, resource=self.resources[name],
+                                                    value_timeout=value_timeout, timeout_fallback=timeout_fallback)
+            self.resources[name].loop = self
+        # History only records values actually read, so it goes inside any wrappers which reuse previous values
+        if history:
+            from approxeng.task.history import HistoryResource, HistoryViewResource
+            self.resources[name] = HistoryResource(name=name, resource=self.resources[name], length=history)
+            self.resources[name].loop = self
+            self.register_resource(name + '_history', HistoryViewResource(self.resources[name]))
+        if failure_policy is not None and not isinstance(res, CircuitBreakerResource):
+            self.resources[name] = CircuitBreakerResource(name=name, resource=self.resources[name],
+                                                          policy=failure_policy)
+            self.resources[name].loop = self
+            self.register_resource(name + '_stale', CircuitStaleResource(self.resources[name]))
+        if pure and not isinstance(res, PureResource):
+            self.resources[name] = PureResource(name=name, resource=self.resources[name])
+            self.resources[name].loop = self
+        if max_age is not None and not isinstance(res, CachedResource):
+            self.resources[name] = CachedResource(name=name, resource=self.resources[name], max_age=max_age)
+            self.resources[name].loop = self
+            self.register_resource(name + '_age', CachedAgeResource(self.resources[name]))
+
+    def notify_changed(self, name):
+        """
+        Record that the named resource has changed, waking the loop if it's waiting for that resource. Called by
+        :meth:`~approxeng.task.Resource.notify_changed`, safe to call from any thread.
+        """
+        with self._wakeup:
+            self._changed.add(name)
+            self._wakeup.notify_all()
+
+    def wait_for_change(self, names, timeout=None):
+        """
+        Block until any of the named resources reports a change, returning immediately if one already has since the
+        last call. Any recorded changes are then forgotten.
+
+        :param names:
+            Set of resource names
+        :param timeout:
+            Longest time to wait in seconds, or None to wait indefinitely
+        :return:
+            Set of the names which changed, empty if the wait timed out
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._wakeup:
+            while self._changed.isdisjoint(names):
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._wakeup.wait(remaining)
+            changed = self._changed.intersection(names)
+            self._changed.clear()
+        return changed
+
+    def get_task(self, t):
+        """
+        Resolve a task instance
+
+        :param t:
+            Either a name, or a Task object
+        :return:
+            The task object, if supplied, or the result of a lookup in this loop's tasks otherwise
+        """
+        if isinstance(t, Task):
+            if t.loop is None:
+                t.loop = self
+            return t
+        return self.tasks[t]
+
+    def get_resource_total_order(self, resources=None):
+        """
+        Resolve a set of resources into an ordering which respects any dependencies, this will also extend the
+        supplied list to include any transitive dependencies if required.
+
+        Orderings are cached for each distinct set of requested names, so repeated calls, such as those made each time
+        a task starts, are cheap. The cache is cleared whenever a resource is registered, if you modify the resources
+        dict directly call :meth:`~approxeng.task.TaskLoop.clear_resource_order_cache` afterwards.
+
+        :param resources:
+            An iterable of resource names, or None to use all names
+        :return:
+            A list of resource names such that no resource depends on a resource later in the list
+        :raises ValueError:
+            If there are cyclic dependencies between the resources, the message includes the names forming the cycle
+        """
+        key = None if resources is None else frozenset(resources)
+        order = self._order_cache.get(key)
+        if order is None:
+            order = _resolve_resource_order(self.resources.keys() if resources is None else resources, self.resources)
+            self._order_cache[key] = order
+        return list(order)
+
+    def clear_resource_order_cache(self):
+        """
+        Discard all cached resource orderings, called automatically when resources are registered. Any tick plans
+        compiled before this are recompiled the next time they're used.
+        """
+        self._order_cache.clear()
+        self.resource_version += 1
+
+    def compile_tick_plan(self, ordered_resources):
+        """
+        Compile a tick plan from an ordered list of resource names.
+
+        :param ordered_resources:
+            A list of resource names, as returned from :meth:`~approxeng.task.TaskLoop.get_resource_total_order`
+        :return:
+            A :class:`~approxeng.task.TickPlan`
+        """
+        resources = self.resources
+        return TickPlan(steps=tuple((name, resources[name], tuple(resources[name].dependencies))
+                                    for name in ordered_resources), version=self.resource_version)
+
+    def run(self, root_task, error_task='exit', check_tasks=None, raise_exceptions=False, tick_rate=None,
+            scheduler=None, resource_executor=None, profiler=None, resource_grace_period=0, prewarm=False,
+            tick_logger=None, recorder=None, replay=None, concurrent_startup=False, resource_timeout=None):
+        """
+        Run the task loop!
+
+        :param root_task:
+            The first task to start with
+        :param error_task:
+            The task to switch to if an exception occurs, defaults to the ExitTask to exit the loop. If you have
+            hardware such as motors that you need to ensure is deactivated, the best approach is to have a task that
+            only does hardware shutdown, handles any errors with that process internally, and then delegates to the exit
+            task to stop the task look. Defaults to the exit task if not specified.
+        :param check_tasks:
+            A sequence of functions which will be called before each tick of the selected task. If any of them return
+            then the return value is used instead of calling and using the value of the task's tick. This can be done to
+            handle cases like 'make the home button always jump back to the root task', or 'exit the task loop on low
+            battery conditions' or similar. Don't put too much logic here, it'll get called every tick. Also good for
+            cases where you absolutely want to bail if hardware isn't available (joystick out of range is a particular
+            case). Check task functions can accept resources as named parameters, just like simple tasks. These
+            resources are started when the loop starts and kept running until it exits, and their values are shared with
+            the active task so each resource is only read once per tick.
+        :param raise_exceptions:
+            Defaults to False, if set to True then any exceptions raised by a task will be handled, then wrapped in a
+            TaskException and raised from this call. If False then they will be handled, and control passed to the
+            designated error task.
+        :param tick_rate:
+            Target rate for the loop in ticks per second, individual tasks may override this with their own tick_rate.
+            If None, and the active task doesn't specify a rate, the loop runs as fast as it can.
+        :param scheduler:
+            Optional :class:`~approxeng.task.TickScheduler` used to pace the loop, supply one if you want to inspect the
+            overrun and lateness information it collects. If this is provided the tick_rate parameter is ignored and the
+            scheduler's own rate is used as the default.
+        :param resource_executor:
+            Optional :class:`concurrent.futures.Executor`, normally a :class:`~concurrent.futures.ThreadPoolExecutor`.
+            If supplied, resources which don't depend on each other are evaluated concurrently within each tick, which
+            helps when several resources block on hardware reads. The caller is responsible for shutting the executor
+            down.
+        :param profiler:
+            Optional :class:`~approxeng.task.profiling.Profiler`. If supplied, timings for each task tick, resource
+            evaluation, check task, and task startup and shutdown are recorded in it. Inspect it after the loop exits to
+            see where the time went, a report is also logged on exit if the profiler's log_on_exit property is True.
+        :param resource_grace_period:
+            Resources shared between tasks are kept running when control passes from one task to another, rather than
+            being shut down and immediately started up again. Resources which are no longer used by any task or check
+            are shut down once they've been idle for this many seconds, or only when the loop exits if this is None.
+            The default of 0 shuts them down as soon as the next task has started.
+        :param prewarm:
+            If True, whenever a task starts the tasks returned by its :meth:`~approxeng.task.Task.successors` method are
+            warmed up on a background thread. Their resources are started, and their
+            :meth:`~approxeng.task.Task.prepare` methods called, so switching to one of them doesn't stall the loop.
+            Resource startup methods must be safe to call from a background thread if you use this.
+        :param tick_logger:
+            Optional :class:`~approxeng.task.TickLogger` to control logging of each tick. The default logs every tick at
+            DEBUG level, but only if that level was enabled when the task started, otherwise nothing at all is done.
+        :param recorder:
+            Optional :class:`~approxeng.task.trace.TraceRecorder`. If supplied, the resource values seen by each tick,
+            the active task and its response are written to a trace, which can be replayed later to reproduce the run.
+            The caller is responsible for closing the recorder.
+        :param replay:
+            Optional :class:`~approxeng.task.trace.TraceReplay`. If supplied, every resource in the trace is replaced
+            in this loop by one which returns the recorded values, so the tasks see exactly what they saw when the
+            trace was recorded and no hardware is touched. The loop runs as fast as it can, unless a scheduler is
+            supplied, and exits when the trace runs out. Any differences between the recorded and replayed responses
+            are collected by the replay.
+        :param concurrent_startup:
+            If True, resources which don't depend on each other are started at the same time on separate threads, as
+            are the resources being shut down, so several slow devices don't add up to a long pause when a task starts
+            or the loop exits. Resource startup and shutdown methods must be safe to call from a background thread if
+            you use this.
+        :param resource_timeout:
+            Optional time limit in seconds for starting or stopping each resource. A resource which doesn't start in
+            time raises a :class:`~approxeng.task.TaskException`, handled like any other error in a task, and one which
+            doesn't shut down in time is abandoned with a warning so the loop can still exit. A startup which timed out
+            carries on in the background, the resource can't be started again until it finishes, and if it did start
+            it's shut down along with everything else. Startup and shutdown times for each resource are logged when the
+            loop exits, and recorded in the profiler if one is supplied.
+        :returns:
+            If the loop exits as the result of a task returning a :class:`~approxeng.task.TaskStop` it will return the
+            value wrapped by that instance, otherwise None.
+        """
+        steps = self.iterate(root_task=root_task, error_task=error_task, check_tasks=check_tasks,
+                             raise_exceptions=raise_exceptions, tick_rate=tick_rate, scheduler=scheduler,
+                             resource_executor=resource_executor, profiler=profiler,
+                             resource_grace_period=resource_grace_period, prewarm=prewarm, tick_logger=tick_logger,
+                             recorder=recorder, replay=replay, concurrent_startup=concurrent_startup,
+                             resource_timeout=resource_timeout)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
+
+    def iterate(self, root_task, error_task='exit', check_tasks=None, raise_exceptions=False, tick_rate=None,
+                scheduler=None, resource_executor=None, profiler=None, resource_grace_period=0, prewarm=False,
+                tick_logger=None, recorder=None, replay=None, concurrent_startup=False, resource_timeout=None):
+        """
+        Run the task loop one tick at a time. This takes the same parameters as :meth:`~approxeng.task.TaskLoop.run`,
+        but returns a generator which runs a single tick each time it's advanced, letting the caller interleave ticks
+        of several loops or do its own pacing. When the loop finishes the generator stops, with the value run would
+        have returned as the value of the StopIteration. Closing the generator early shuts down the loop's resources.
+
+        .. code-block:: python
+
+            steps = loop.iterate(root_task='drive')
+            for _ in steps:
+                # Runs once after each tick
+                pass
+        """
+        # Start with the root task as the active one
+        active_task = self.get_task(root_task)
+        # Paces the loop to the requested tick rate, if any, replays run as fast as possible by default
+        if scheduler is None:
+            scheduler = TickScheduler(tick_rate=tick_rate) if replay is None else UnpacedScheduler()
+        if replay is not None:
+            replay.install(self)
+        # Values computed in each tick, shared between the check tasks and the active task
+        cache = ResourceCache(executor=resource_executor, profiler=profiler, resources=self.resources)
+        checks = [CheckTask(check_task) for check_task in check_tasks] if check_tasks is not None else []
+        # Reference counts resources, so ones shared between tasks are kept running across task switches. Resources
+        # needed by the check tasks are held for the lifetime of the loop
+        manager = ResourceManager(grace_period=resource_grace_period, loop=self, concurrent=concurrent_startup,
+                                  timeout=resource_timeout, profiler=profiler)
+        prewarmer = Prewarmer(manager) if prewarm else None
+        # Bound to a log function when each task starts, None if tick logging is disabled
+        if tick_logger is None:
+            tick_logger = TickLogger()
+        tick_log = None
+        # Tasks whose tick overran its tick_timeout, and may still be running it, waiting to be shut down
+        overrunning = []
+
+        def shut_down(task):
+            if task.watchdog is not None and task.watchdog.busy:
+                # The abandoned tick may still be using the task's resources, so leave them until it returns
+                if task not in overrunning:
+                    LOG.warning('Task "%s" is still running an overrunning tick, shutting down once it returns',
+                                task.name)
+                    overrunning.append(task)
+            else:
+                _timed(profiler, 'shutdown', task.name, task.do_shutdown, manager=manager)
+
+        def finish_overruns():
+            for task in [task for task in overrunning if not task.watchdog.busy]:
+                overrunning.remove(task)
+                # If control has passed back to the task it's still running, so carry on using it
+                if task is not active_task:
+                    _timed(profiler, 'shutdown', task.name, task.do_shutdown, manager=manager)
+
+        # Loop until we're done
+        finished = False
+        return_value = None
+        try:
+            check_resources = _start_check_tasks(checks, manager)
+            poll_period = _check_poll_period(checks, scheduler)
+            # Replayed resources never report changes, so tasks with wake_on would just sleep until they time out
+            wait_for_changes = replay is None and scheduler.waits_for_changes
+            while not finished:
+                try:
+                    response = None
+                    if active_task.wake_on is not None and active_task.active and wait_for_changes:
+                        # Sleep until something the task or checks use changes, and don't count that as lateness
+                        self.wait_for_change(active_task.wake_names | check_resources,
+                                             _wake_timeout(active_task, poll_period))
+                        scheduler.reset()
+                    scheduler.wait(active_task.tick_rate)
+                    cache.clear()
+                    if overrunning:
+                        finish_overruns()
+                    if replay is not None and not replay.advance():
+                        # Nothing left in the trace
+                        break
+                    global_count = self.global_count
+                    # If we have any pre-task checks to run do them now. If any of those functions return
+                    # non-None values we'll use those in place of the active task. Code these carefully!
+                    # Here's where you'd check for e.g. joystick not connected.
+                    for check in checks:
+                        check_response = _timed(profiler, 'check', check.name, check,
+                                                cache=cache, global_count=self.global_count)
+                        if check_response is not None:
+                            response = check_response
+                    # If no check_task functions returned anything, run the actual task tick
+                    if response is None:
+                        if not active_task.active:
+                            _timed(profiler, 'startup', active_task.name, active_task.do_startup, manager=manager)
+                            if prewarmer is not None:
+                                prewarmer.warm(active_task)
+                            tick_log = tick_logger.bind()
+                        # Shut down anything no longer used by the active task or checks, once idle for long enough
+                        manager.collect()
+                        if tick_log is not None:
+                            tick_log(active_task, self.global_count)
+                        if active_task.watchdog is None:
+                            response = _timed(profiler, 'tick', active_task.name, active_task.do_tick, cache=cache)
+                        else:
+                            response = _timed(profiler, 'tick', active_task.name, _watched_tick, active_task, cache)
+                    if recorder is not None:
+                        recorder.record(global_count, active_task.name, cache.values, response)
+                    if replay is not None:
+                        replay.check(active_task.name, response)
+                    # If the tick function returned a value it means we need to switch control
+                    if response is not None:
+                        if isinstance(response, Task) or isinstance(response, str):
+                            # New task, either name or Task object. Shut down and switch to it for the next tick
+                            shut_down(active_task)
+                            active_task = self.get_task(response)
+                        elif isinstance(response, TaskStop):
+                            # TaskStop value returned
+                            shut_down(active_task)
+                            finished = True
+                            return_value = response.return_value
+                except Exception as e:
+                    # Anything throwing an exception ends up here. Log it first, then delegate to a handler task
+                    LOG.exception('Exception raised within task loop')
+                    # Shut the active task down, add the exception to the world as 'error' and launch the error task
+                    shut_down(active_task)
+                    if raise_exceptions:
+                        raise TaskException from e
+                    self.register_resource('error', e)
+                    active_task = self.get_task(error_task)
+                # Hand control back to the caller after each tick
+                yield
+        except TaskException as te:
+            # Catch and stash the exception in the return value
+            return_value = te
+        finally:
+            # Finished, shut down all resources and exit
+            if prewarmer is not None:
+                prewarmer.stop()
+            finish_overruns()
+            # Resources used by ticks which still haven't returned are left running
+            held = [name for task in overrunning for name in task.ordered_resources]
+            if held:
+                LOG.warning('Leaving resources %s running, still in use by overrunning ticks', held)
+            manager.shutdown_all(keep=held)
+            if profiler is not None and profiler.log_on_exit:
+                LOG.info('Task loop timings (ms):\n%s', profiler.report())
+        # If we're raising exceptions, and there was an exception, raise it.
+        if raise_exceptions and isinstance(return_value, Exception):
+            raise return_value
+        # Otherwise return the return value and exit.
+        return return_value
+
+    async def run_async(self, root_task, error_task='exit', check_tasks=None, raise_exceptions=False,
+                        tick_rate=None, scheduler=None, profiler=None, resource_grace_period=0, prewarm=False,
+                        tick_logger=None, concurrent_startup=False, resource_timeout=None):
+        """
+        Run the task loop as a coroutine. This behaves exactly as :meth:`~approxeng.task.TaskLoop.run`, and takes the
+        same parameters apart from resource_executor, recorder and replay, but tasks, check tasks and resources may be
+        ``async def`` functions, or :class:`~approxeng.task.Task` and :class:`~approxeng.task.Resource` classes with
+        coroutine tick or value methods. Resources within a tick are evaluated concurrently where their dependencies
+        allow, so slow I/O bound reads overlap rather than adding up, and the loop yields to the event loop between each
+        tick so other coroutines can run.
+
+        .. code-block:: python
+
+            import asyncio
+            from approxeng.task import run_async
+
+            asyncio.run(run_async(root_task='main_menu', tick_rate=50))
+        """
+        active_task = self.get_task(root_task)
+        if scheduler is None:
+            scheduler = TickScheduler(tick_rate=tick_rate)
+        cache = ResourceCache(profiler=profiler, resources=self.resources)
+        checks = [CheckTask(check_task) for check_task in check_tasks] if check_tasks is not None else []
+        manager = ResourceManager(grace_period=resource_grace_period, loop=self, concurrent=concurrent_startup,
+                                  timeout=resource_timeout, profiler=profiler)
+        prewarmer = Prewarmer(manager) if prewarm else None
+        # Bound to a log function when each task starts, None if tick logging is disabled
+        if tick_logger is None:
+            tick_logger = TickLogger()
+        tick_log = None
+        finished = False
+        return_value = None
+        try:
+            check_resources = _start_check_tasks(checks, manager)
+            poll_period = _check_poll_period(checks, scheduler)
+            while not finished:
+                try:
+                    response = None
+                    if active_task.wake_on is not None and active_task.active and scheduler.waits_for_changes:
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self.wait_for_change, active_task.wake_names | check_resources,
+                            _wake_timeout(active_task, poll_period))
+                        scheduler.reset()
+                    await scheduler.wait_async(active_task.tick_rate)
+                    cache.clear()
+                    for check in checks:
+                        check_response = await check.call_async(cache=cache, global_count=self.global_count)
+                        if check_response is not None:
+                            response = check_response
+                    if response is None:
+                        if not active_task.active:
+                            _timed(profiler, 'startup', active_task.name, active_task.do_startup, manager=manager)
+                            if prewarmer is not None:
+                                prewarmer.warm(active_task)
+                            tick_log = tick_logger.bind()
+                        # Shut down anything no longer used by the active task or checks, once idle for long enough
+                        manager.collect()
+                        if tick_log is not None:
+                            tick_log(active_task, self.global_count)
+                        start = perf_counter()
+                        if active_task.tick_timeout is None:
+                            response = await active_task.do_tick_async(cache=cache)
+                        else:
+                            response = await _within_budget(active_task.do_tick_async(cache=cache),
+                                                            active_task.tick_timeout, 'task-' + active_task.name)
+                        if profiler is not None:
+                            profiler.record('tick', active_task.name, perf_counter() - start)
+                    if response is not None:
+                        if isinstance(response, Task) or isinstance(response, str):
+                            _timed(profiler, 'shutdown', active_task.name, active_task.do_shutdown, manager=manager)
+                            active_task = self.get_task(response)
+                        elif isinstance(response, TaskStop):
+                            _timed(profiler, 'shutdown', active_task.name, active_task.do_shutdown, manager=manager)
+                            finished = True
+                            return_value = response.return_value
+                except Exception as e:
+                    LOG.exception('Exception raised within task loop')
+                    _timed(profiler, 'shutdown', active_task.name, active_task.do_shutdown, manager=manager)
+                    if raise_exceptions:
+                        raise TaskException from e
+                    self.register_resource('error', e)
+                    active_task = self.get_task(error_task)
+        except TaskException as te:
+            return_value = te
+        finally:
+            if prewarmer is not None:
+                prewarmer.stop()
+            manager.shutdown_all()
+            if profiler is not None and profiler.log_on_exit:
+                LOG.info('Task loop timings (ms):\n%s', profiler.report())
+        if raise_exceptions and isinstance(return_value, Exception):
+            raise return_value
+        return return_value
+
+
+class _DefaultTaskLoop(TaskLoop):
+    """
+    The loop used by the module level functions. Its global count is kept in Task.global_count, as it was before
+    loops had their own.
+    """
+
+    @property
+    def global_count(self):
+        return Task.global_count
+
+    @global_count.setter
+    def global_count(self, value):
+        Task.global_count = value
+
+
+DEFAULT_LOOP = _DefaultTaskLoop()
+# Tasks and resources registered with the default loop
+TASKS = DEFAULT_LOOP.tasks
+RESOURCES = DEFAULT_LOOP.resources
+
+
+def run(root_task, error_task='exit', check_tasks=None, raise_exceptions=False, tick_rate=None, scheduler=None,
+        resource_executor=None, profiler=None, resource_grace_period=0, prewarm=False, tick_logger=None, recorder=None,
+        replay=None, concurrent_startup=False, resource_timeout=None):
+    """
+    Run the default task loop, see :meth:`~approxeng.task.TaskLoop.run` for details of the parameters.
+
+    :returns:
+        If the loop exits as the result of a task returning a :class:`~approxeng.task.TaskStop` it will return the
+        value wrapped by that instance, otherwise None.
+    """
+    return DEFAULT_LOOP.run(root_task=root_task, error_task=error_task, check_tasks=check_tasks,
+                            raise_exceptions=raise_exceptions, tick_rate=tick_rate, scheduler=scheduler,
+                            resource_executor=resource_executor, profiler=profiler,
+                            resource_grace_period=resource_grace_period, prewarm=prewarm, tick_logger=tick_logger,
+                            recorder=recorder, replay=replay, concurrent_startup=concurrent_startup,
+                            resource_timeout=resource_timeout)
+
+
+async def run_async(root_task, error_task='exit', check_tasks=None, raise_exceptions=False, tick_rate=None,
+                    scheduler=None, profiler=None, resource_grace_period=0, prewarm=False, tick_logger=None,
+                    concurrent_startup=False, resource_timeout=None):
+    """
+    Run the default task loop as a coroutine, see :meth:`~approxeng.task.TaskLoop.run_async`.
+
+    .. code-block:: python
+
+        import asyncio
+        from approxeng.task import run_async
+
+        asyncio.run(run_async(root_task='main_menu', tick_rate=50))
+    """
+    return await DEFAULT_LOOP.run_async(root_task=root_task, error_task=error_task, check_tasks=check_tasks,
+                                        raise_exceptions=raise_exceptions, tick_rate=tick_rate, scheduler=scheduler,
+                                        profiler=profiler, resource_grace_period=resource_grace_period,
+                                        prewarm=prewarm, tick_logger=tick_logger, concurrent_startup=concurrent_startup,
+                                        resource_timeout=resource_timeout)
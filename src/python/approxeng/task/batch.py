@@ -0,0 +1,156 @@
+import logging
+import multiprocessing
+from time import perf_counter
+
+from approxeng.task import UnpacedScheduler
+
+LOG = logging.getLogger('approxeng.task.batch')
+
+
+class BatchResult:
+    """
+    The outcome of a call to :func:`~approxeng.task.batch.run_batch`.
+    """
+
+    def __init__(self, results, ticks, seconds):
+        """
+        :param results:
+            List containing the value returned by each episode's loop, in the same order as the configurations. Any
+            episode stopped by the max_ticks limit has a result of None.
+        :param ticks:
+            Total number of ticks run across all episodes
+        :param seconds:
+            Wall clock time taken by the whole batch, including starting worker processes
+        """
+        self.results = results
+        self.ticks = ticks
+        self.seconds = seconds
+
+    @property
+    def ticks_per_second(self):
+        """
+        Aggregate throughput across all episodes and processes.
+        """
+        return self.ticks / self.seconds if self.seconds > 0 else 0.0
+
+
+def run_episodes(build_loop, configurations, root_task, max_ticks=None, **run_args):
+    """
+    Run a set of episodes in lock-step in the current process. One loop is built for each configuration, then each
+    unfinished loop is advanced by a single tick in turn until they've all finished.
+
+    :param build_loop:
+        Function taking a configuration and returning a :class:`~approxeng.task.TaskLoop` with its tasks and resources
+        registered
+    :param configurations:
+        Sequence of configurations, one per episode
+    :param root_task:
+        Name of the task each loop starts with
+    :param max_ticks:
+        If specified, episodes still running after this many ticks are stopped, with a result of None
+    :param run_args:
+        Any other arguments are passed to :meth:`~approxeng.task.TaskLoop.iterate`
+    :return:
+        A tuple of list of results, in the same order as the configurations, and the total number of ticks run
+    """
+    results = [None] * len(configurations)
+    running = []
+    for index, configuration in enumerate(configurations):
+        loop = build_loop(configuration)
+        running.append((index, loop.iterate(root_task=root_task, scheduler=UnpacedScheduler(), **run_args)))
+    ticks = 0
+    step = 0
+    try:
+        while running and (max_ticks is None or step < max_ticks):
+            still_running = []
+            for index, steps in running:
+                try:
+                    next(steps)
+                    ticks += 1
+                    still_running.append((index, steps))
+                except StopIteration as stop:
+                    results[index] = stop.value
+            running = still_running
+            step += 1
+    finally:
+        # Shut down anything which didn't finish
+        for _, steps in running:
+            steps.close()
+    return results, ticks
+
+
+def _run_chunk(arguments):
+    build_loop, indices, configurations, root_task, max_ticks, run_args = arguments
+    results, ticks = run_episodes(build_loop=build_loop, configurations=configurations, root_task=root_task,
+                                  max_ticks=max_ticks, **run_args)
+    return indices, results, ticks
+
+
+def run_batch(build_loop, configurations, root_task, processes=None, max_ticks=None, **run_args):
+    """
+    Run many independent episodes, such as simulations used to tune controller parameters, as fast as possible. The
+    configurations are split between worker processes, each of which builds a :class:`~approxeng.task.TaskLoop` for
+    each of its configurations and steps them in lock-step with no pacing, so tick rates set on tasks are ignored.
+
+    .. code-block:: python
+
+        from approxeng.task import TaskLoop, TaskStop
+        from approxeng.task.batch import run_batch
+
+        def build_loop(gain):
+            loop = TaskLoop()
+
+            @loop.task
+            def settle(task_state, task_count):
+                error = task_state.get('error', 1.0)
+                if abs(error) < 0.01 or task_count > 1000:
+                    return TaskStop(task_count)
+                task_state['error'] = error * (1 - gain)
+
+            return loop
+
+        batch = run_batch(build_loop, configurations=[0.1, 0.2, 0.5], root_task='settle')
+        print(batch.results, batch.ticks_per_second)
+
+    :param build_loop:
+        Function taking a configuration and returning a :class:`~approxeng.task.TaskLoop` with its tasks and resources
+        registered. This and the configurations are sent to the worker processes, so must be picklable if the
+        platform doesn't fork new processes, which in practice means it should be defined at the top level of a module.
+    :param configurations:
+        Sequence of configurations, one per episode
+    :param root_task:
+        Name of the task each loop starts with
+    :param processes:
+        Number of worker processes, defaults to the number of processors. If 0, episodes are run in this process.
+    :param max_ticks:
+        If specified, episodes still running after this many ticks are stopped, with a result of None
+    :param run_args:
+        Any other arguments, such as check_tasks, are passed to :meth:`~approxeng.task.TaskLoop.iterate`
+    :return:
+        A :class:`~approxeng.task.batch.BatchResult`, containing the value each episode's loop returned, normally
+        from a :class:`~approxeng.task.TaskStop`, and the aggregate tick rate
+    """
+    configurations = list(configurations)
+    start = perf_counter()
+    if processes == 0:
+        results, ticks = run_episodes(build_loop=build_loop, configurations=configurations, root_task=root_task,
+                                      max_ticks=max_ticks, **run_args)
+        return BatchResult(results=results, ticks=ticks, seconds=perf_counter() - start)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(configurations)))
+    # Interleave configurations so that slow episodes, which tend to have similar configurations, are spread out
+    chunks = [(build_loop, list(range(offset, len(configurations), processes)),
+               configurations[offset::processes], root_task, max_ticks, run_args)
+              for offset in range(processes)]
+    results = [None] * len(configurations)
+    ticks = 0
+    with multiprocessing.Pool(processes=processes) as pool:
+        for indices, chunk_results, chunk_ticks in pool.imap_unordered(_run_chunk, chunks):
+            for index, result in zip(indices, chunk_results):
+                results[index] = result
+            ticks += chunk_ticks
+    batch = BatchResult(results=results, ticks=ticks, seconds=perf_counter() - start)
+    LOG.info('Ran %i episodes, %i ticks in %.2fs, %.0f ticks per second', len(configurations), ticks, batch.seconds,
+             batch.ticks_per_second)
+    return batch
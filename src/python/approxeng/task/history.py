@@ -0,0 +1,213 @@
+import inspect
+import logging
+from time import monotonic
+
+import numpy as np
+
+from approxeng.task import Resource
+
+LOG = logging.getLogger('approxeng.task.history')
+
+
+class RingBuffer:
+    """
+    Fixed size history of numeric or array values, backed by numpy arrays allocated when the first value is added. The
+    storage is twice the length of the buffer and each value is written to both halves, so the most recent values are
+    always available as a single contiguous slice and can be returned as a view without copying.
+
+    Views are read only and are only valid until the next value is added, copy them if you need to keep them.
+    """
+
+    def __init__(self, length):
+        """
+        :param length:
+            Maximum number of values held
+        """
+        self.length = length
+        self.count = 0
+        self._index = 0
+        self._values = None
+        self._times = np.zeros(length * 2)
+
+    def clear(self):
+        """
+        Discard all values, the storage is kept so the next value must have the same shape.
+        """
+        self.count = 0
+        self._index = 0
+
+    def append(self, value, timestamp=None):
+        """
+        Add a value, discarding the oldest if the buffer is full.
+
+        :param value:
+            A number, or anything which can be converted to a numpy array of the same shape as previous values
+        :param timestamp:
+            Time the value was read, defaults to the current monotonic time
+        """
+        if self._values is None:
+            value = np.asarray(value)
+            self._values = np.zeros((self.length * 2,) + value.shape, dtype=value.dtype)
+        index = self._index
+        upper = index + self.length
+        values = self._values
+        values[index] = value
+        values[upper] = value
+        times = self._times
+        times[index] = times[upper] = monotonic() if timestamp is None else timestamp
+        self._index = (index + 1) % self.length
+        if self.count < self.length:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count == self.length
+
+    def _view(self, array, window):
+        count = self.count if window is None else min(window, self.count)
+        end = self._index + self.length
+        view = array[end - count:end]
+        view.flags.writeable = False
+        return view
+
+    def values(self, window=None):
+        """
+        :param window:
+            Number of most recent values to return, defaults to all of them
+        :return:
+            A read only view of the values, oldest first, with time as the first axis
+        """
+        if self._values is None:
+            return np.zeros(0)
+        return self._view(self._values, window)
+
+    def times(self, window=None):
+        """
+        :param window:
+            Number of most recent timestamps to return, defaults to all of them
+        :return:
+            A read only view of the monotonic times at which the values were read, oldest first
+        """
+        return self._view(self._times, window)
+
+    @property
+    def latest(self):
+        """
+        The most recent value, or None if the buffer is empty.
+        """
+        if self.count == 0:
+            return None
+        return self._values[self._index + self.length - 1]
+
+    def mean(self, window=None):
+        """
+        Mean of the most recent values, or of all of them if window is None. Returns None if the buffer is empty.
+        """
+        return self.values(window).mean(axis=0) if self.count else None
+
+    def min(self, window=None):
+        """
+        Minimum of the most recent values, or of all of them if window is None. Returns None if the buffer is empty.
+        """
+        return self.values(window).min(axis=0) if self.count else None
+
+    def max(self, window=None):
+        """
+        Maximum of the most recent values, or of all of them if window is None. Returns None if the buffer is empty.
+        """
+        return self.values(window).max(axis=0) if self.count else None
+
+    def derivative(self, window=None):
+        """
+        Average rate of change per second across the most recent values, or across all of them if window is None.
+        Returns None if there are fewer than two values, or if they were all read at the same time.
+        """
+        if self.count < 2:
+            return None
+        values = self.values(window)
+        times = self.times(window)
+        elapsed = times[-1] - times[0]
+        if len(values) < 2 or elapsed <= 0:
+            return None
+        return (values[-1] - values[0]) / elapsed
+
+
+class HistoryResource(Resource):
+    """
+    Wraps another resource, adding each value it produces to a :class:`~approxeng.task.history.RingBuffer`. Register
+    resources with a history length rather than creating this directly, the buffer is then available to tasks as a
+    separate resource with '_history' appended to the name, so a task function can ask for both:
+
+    .. code-block:: python
+
+        from approxeng.task import resource, task
+
+        @resource(history=50)
+        def distance():
+            return read_rangefinder()
+
+        @task
+        def approach(distance, distance_history):
+            speed = distance_history.derivative(window=10)
+            ...
+
+    The history is cleared whenever the resource is started, and None values are not recorded.
+    """
+
+    def __init__(self, name, resource, length):
+        """
+        :param name:
+            Name used when referencing this resource
+        :param resource:
+            The resource whose values should be recorded
+        :param length:
+            Number of values to keep
+        """
+        super(HistoryResource, self).__init__(name=name, dependencies=list(resource.dependencies))
+        self.resource = resource
+        self.buffer = RingBuffer(length)
+
+    def startup(self):
+        self.buffer.clear()
+        self.resource.startup()
+
+    def shutdown(self):
+        self.resource.shutdown()
+
+    def value(self, **kwargs):
+        value = self.resource.value(**kwargs)
+        if inspect.isawaitable(value):
+            return self._append_async(value)
+        if value is not None:
+            self.buffer.append(value)
+        return value
+
+    async def _append_async(self, awaitable):
+        value = await awaitable
+        if value is not None:
+            self.buffer.append(value)
+        return value
+
+
+class HistoryViewResource(Resource):
+    """
+    Provides the ring buffer of a :class:`~approxeng.task.history.HistoryResource` to tasks. Depends on the history
+    resource so the buffer always includes the current tick's value.
+    """
+
+    def __init__(self, history_resource):
+        super(HistoryViewResource, self).__init__(name=history_resource.name + '_history',
+                                                  dependencies=[history_resource.name])
+        self.history_resource = history_resource
+
+    def startup(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def value(self, **kwargs):
+        return self.history_resource.buffer
@@ -21,10 +21,14 @@ class MenuTask(Task):
     """
     A single menu, consisting of a title and a set of items, each of which will launch a
     task when selected. Optionally menus may have a parent.
+
+    Menus spend most of their time waiting for input, so if the input resources call
+    :meth:`~approxeng.task.Resource.notify_changed` when a button is pressed, pass their names as wake_on and the
+    menu will only tick when there's something to do, rather than polling for an action on every tick.
     """
 
-    def __init__(self, name, title, parent_task, resources=None):
-        super(MenuTask, self).__init__(name, resources)
+    def __init__(self, name, title, parent_task, resources=None, wake_on=None, wake_timeout=None):
+        super(MenuTask, self).__init__(name, resources, wake_on=wake_on, wake_timeout=wake_timeout)
         self.name = name
         self.title = title
         self.parent_task = parent_task
@@ -38,6 +42,15 @@ class MenuTask(Task):
         LOG.debug('Adding "%s"->%s to menu task %s', title, task_name, self.name)
         self.items.append({'title': title, 'task': task_name})
 
+    def successors(self):
+        """
+        Any task in the menu, or the parent menu, could be selected next.
+        """
+        successors = [item['task'] for item in self.items]
+        if self.parent_task is not None:
+            successors.append(self.parent_task)
+        return successors
+
     def startup(self):
         """
         :internal:
@@ -143,7 +156,7 @@ def unique_id(prefix):
     return prefix + '_' + str(uuid.uuid4())
 
 
-def register_menu_tasks_from_yaml(filename, menu_task_class=MenuTask, resources=None):
+def register_menu_tasks_from_yaml(filename, menu_task_class=MenuTask, resources=None, wake_on=None, wake_timeout=None):
     """
 
     :param filename:
@@ -155,6 +168,10 @@ def register_menu_tasks_from_yaml(filename, menu_task_class=MenuTask, resources=
         A list of names of resources which should be made available to the menu task instances. These are generally
         going to be a display and some kind of input facility and will be used when displaying and receiving navigation
         instructions.
+    :param wake_on:
+        Optional resource names passed to each menu task, if supplied menus only tick when one of these changes
+    :param wake_timeout:
+        Longest time in seconds menus wait for a change before ticking anyway, if wake_on is set
     :return:
         A list of all the new task names created. Task names which are created dynamically are included, these will
         appear if you have any nested (anonymous) menus, or any return values as both of these are mapped to new tasks
@@ -163,12 +180,13 @@ def register_menu_tasks_from_yaml(filename, menu_task_class=MenuTask, resources=
     with open(filename, 'r') as stream:
         try:
             menu_dicts = yaml.safe_load(stream)
-            return register_menu_tasks(menu_dicts=menu_dicts, menu_task_class=menu_task_class, resources=resources)
+            return register_menu_tasks(menu_dicts=menu_dicts, menu_task_class=menu_task_class, resources=resources,
+                                       wake_on=wake_on, wake_timeout=wake_timeout)
         except yaml.YAMLError as exc:
             LOG.error('Unable to load YAML from %s', filename, exc_info=True)
 
 
-def register_menu_tasks(menu_dicts, menu_task_class=MenuTask, resources=None):
+def register_menu_tasks(menu_dicts, menu_task_class=MenuTask, resources=None, wake_on=None, wake_timeout=None):
     """
 
     :param menu_dicts:
@@ -181,6 +199,10 @@ def register_menu_tasks(menu_dicts, menu_task_class=MenuTask, resources=None):
         A list of names of resources which should be made available to the menu task instances. These are generally
         going to be a display and some kind of input facility and will be used when displaying and receiving navigation
         instructions.
+    :param wake_on:
+        Optional resource names passed to each menu task, if supplied menus only tick when one of these changes
+    :param wake_timeout:
+        Longest time in seconds menus wait for a change before ticking anyway, if wake_on is set
     :returns:
         A list of all the new task names created. Task names which are created dynamically are included, these will
         appear if you have any nested (anonymous) menus, or any return values as both of these are mapped to new tasks
@@ -197,7 +219,13 @@ def register_menu_tasks(menu_dicts, menu_task_class=MenuTask, resources=None):
         parent = None
         if 'parent_task' in menu:
             parent = menu['parent_task']
-        task = menu_task_class(name=name, title=title, parent_task=parent, resources=resources)
+        # Only pass the wake arguments if they're used, so menu task classes which don't accept them still work
+        wake_args = {}
+        if wake_on is not None:
+            wake_args['wake_on'] = wake_on
+        if wake_timeout is not None:
+            wake_args['wake_timeout'] = wake_timeout
+        task = menu_task_class(name=name, title=title, parent_task=parent, resources=resources, **wake_args)
         all_task_names.append(name)
         for item in menu['items']:
             if 'menu' in item:
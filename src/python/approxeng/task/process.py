@@ -0,0 +1,215 @@
+import inspect
+import logging
+import multiprocessing
+
+from approxeng.task import Resource, SimpleTask, TaskException
+
+LOG = logging.getLogger('approxeng.task.process')
+
+
+def _worker_main(func, connection):
+    """
+    Entry point for worker processes. Receives dicts of keyword arguments, calls the function with them, and sends back
+    tuples of (True, result) or (False, exception), exiting when it receives None.
+    """
+    while True:
+        kwargs = connection.recv()
+        if kwargs is None:
+            break
+        try:
+            connection.send((True, func(**kwargs)))
+        except Exception as e:
+            try:
+                connection.send((False, e))
+            except Exception:
+                # Exception couldn't be pickled, send a description of it instead
+                connection.send((False, TaskException(repr(e))))
+    connection.close()
+
+
+class ProcessWorker:
+    """
+    A single worker process which calls a function with keyword arguments sent over a pipe. At most one call is in
+    flight at any one time.
+    """
+
+    def __init__(self, func, name):
+        """
+        :param func:
+            The function to call, this must be picklable if the platform doesn't fork new processes, which in practice
+            means it should be defined at the top level of a module.
+        :param name:
+            Name for the process, used in logging
+        """
+        self.func = func
+        self.name = name
+        self.busy = False
+        self._process = None
+        self._connection = None
+
+    @property
+    def running(self):
+        return self._process is not None
+
+    def start(self):
+        """
+        Start the worker process, if it isn't already running.
+        """
+        if self._process is not None:
+            return
+        parent_connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_worker_main, args=(self.func, child_connection),
+                                                name=self.name, daemon=True)
+        self._process.start()
+        child_connection.close()
+        self._connection = parent_connection
+        self.busy = False
+        LOG.info('Started worker process "%s"', self.name)
+
+    def stop(self, timeout=2.0):
+        """
+        Stop the worker process, waiting up to timeout seconds for it to exit before terminating it.
+        """
+        if self._process is None:
+            return
+        try:
+            self._connection.send(None)
+        except (OSError, EOFError):
+            pass
+        self._process.join(timeout=timeout)
+        if self._process.is_alive():
+            LOG.warning('Worker process "%s" did not exit, terminating', self.name)
+            self._process.terminate()
+            self._process.join()
+        self._connection.close()
+        self._process = None
+        self._connection = None
+        self.busy = False
+
+    def submit(self, kwargs):
+        """
+        Send arguments to the worker, starting a new call.
+        """
+        if self.busy:
+            raise TaskException('Worker "{}" is already busy'.format(self.name))
+        self._connection.send(kwargs)
+        self.busy = True
+
+    def ready(self):
+        """
+        True if the current call has finished and its result can be collected without waiting.
+        """
+        return self.busy and self._connection.poll()
+
+    def result(self):
+        """
+        Wait for and return the result of the current call, raising any exception it raised.
+        """
+        if not self.busy:
+            raise TaskException('Worker "{}" has no call in progress'.format(self.name))
+        try:
+            success, value = self._connection.recv()
+        except EOFError:
+            self.busy = False
+            raise TaskException('Worker process "{}" exited unexpectedly'.format(self.name))
+        self.busy = False
+        if not success:
+            raise value
+        return value
+
+    def call(self, kwargs):
+        """
+        Call the function in the worker and wait for the result.
+        """
+        self.submit(kwargs)
+        return self.result()
+
+
+class ProcessResource(Resource):
+    """
+    Resource which computes its value in a separate worker process. Use this for CPU heavy resources such as image
+    processing, which would otherwise hold the GIL and starve the task loop. Dependencies are taken from the value
+    function's parameters as for simple resources, and their values, along with the result, are pickled across a pipe
+    between the processes so keep them reasonably compact.
+
+    By default each call to value() waits for the worker. If pipelined is True the resource instead returns the most
+    recent finished result and starts the worker on the current inputs if it's idle, so the task loop never waits
+    after the first tick at the cost of seeing results computed from slightly older inputs.
+    """
+
+    def __init__(self, name, value_func, pipelined=False):
+        """
+        :param name:
+            Name used when referencing this resource
+        :param value_func:
+            Function to call in the worker process. This must be picklable if the platform doesn't fork new processes.
+        :param pipelined:
+            If True, don't wait for the worker on each tick, return the most recent result instead
+        """
+        super(ProcessResource, self).__init__(name=name,
+                                              dependencies=list(inspect.signature(value_func).parameters.keys()))
+        self.pipelined = pipelined
+        self.worker = ProcessWorker(func=value_func, name='resource-{}'.format(name))
+        self._latest = None
+
+    def startup(self):
+        self._latest = None
+        self.worker.start()
+
+    def shutdown(self):
+        self.worker.stop()
+
+    def value(self, **kwargs):
+        worker = self.worker
+        if not self.pipelined:
+            return worker.call(kwargs)
+        if not worker.busy:
+            worker.submit(kwargs)
+        if self._latest is None or worker.ready():
+            # Only waits on the first tick, or if the result is already there
+            self._latest = (worker.result(),)
+            worker.submit(kwargs)
+        return self._latest[0]
+
+
+class ProcessTask(SimpleTask):
+    """
+    Simple task which calls its task function in a separate worker process, started when the task starts and stopped
+    when it shuts down. The task state dict is sent to the worker along with the other arguments, and the modified
+    state sent back after each call, so it behaves in the same way as for a normal simple task. Return values must be
+    picklable, which in practice means task names or :class:`~approxeng.task.TaskStop` instances rather than tasks.
+    """
+
+    def __init__(self, task_function, name, tick_rate=None, wake_on=None, wake_timeout=None, tick_timeout=None):
+        super(ProcessTask, self).__init__(task_function=task_function, name=name, tick_rate=tick_rate,
+                                          wake_on=wake_on, wake_timeout=wake_timeout, tick_timeout=tick_timeout)
+        self.worker = ProcessWorker(func=_StatefulCall(task_function), name='task-{}'.format(name))
+
+    def startup(self):
+        super(ProcessTask, self).startup()
+        self.worker.start()
+
+    def shutdown(self):
+        self.worker.stop()
+        super(ProcessTask, self).shutdown()
+
+    def tick(self, world):
+        values = world.dict
+        values['task_state'] = self.state
+        response, state = self.worker.call({arg: values[arg] for arg in self.bound_args})
+        if state is not None:
+            self.state.clear()
+            self.state.update(state)
+        return response
+
+
+class _StatefulCall:
+    """
+    Wraps a task function so that the worker sends back the task state along with the return value.
+    """
+
+    def __init__(self, task_function):
+        self.task_function = task_function
+
+    def __call__(self, **kwargs):
+        return self.task_function(**kwargs), kwargs.get('task_state')
@@ -0,0 +1,180 @@
+import logging
+import math
+import threading
+from time import perf_counter
+
+LOG = logging.getLogger('approxeng.task.profiling')
+
+
+class Histogram:
+    """
+    Fixed memory histogram of durations, using logarithmically spaced buckets so that percentiles are accurate to
+    within a bucket width regardless of scale. The count, total and maximum are tracked exactly.
+    """
+
+    def __init__(self, minimum=1e-6, maximum=100.0, buckets_per_decade=20):
+        """
+        :param minimum:
+            Smallest duration in seconds distinguished by the histogram, anything smaller goes in the first bucket
+        :param maximum:
+            Largest duration in seconds distinguished by the histogram, anything larger goes in the last bucket
+        :param buckets_per_decade:
+            Number of buckets for each factor of ten, higher values give more accurate percentiles
+        """
+        self.minimum = minimum
+        self.buckets_per_decade = buckets_per_decade
+        self._log_minimum = math.log10(minimum)
+        self.bucket_count = int(math.ceil((math.log10(maximum) - self._log_minimum) * buckets_per_decade)) + 1
+        self.counts = [0] * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Record a single duration.
+        """
+        if seconds <= self.minimum:
+            index = 0
+        else:
+            index = min(int((math.log10(seconds) - self._log_minimum) * self.buckets_per_decade) + 1,
+                        self.bucket_count - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def bucket_upper_bound(self, index):
+        """
+        The largest duration which would be recorded in the given bucket.
+        """
+        return 10 ** (self._log_minimum + index / self.buckets_per_decade)
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile from the recorded durations, returned as the upper bound of the bucket containing it,
+        capped at the maximum recorded value.
+
+        :param percent:
+            Percentile to compute, from 0 to 100
+        :return:
+            Duration in seconds, or 0.0 if nothing has been recorded
+        """
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * percent / 100.0
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= threshold and bucket_count:
+                return min(self.bucket_upper_bound(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        :return:
+            A dict containing count, mean, p50, p95, p99 and max, with all durations in seconds
+        """
+        return {'count': self.count,
+                'mean': self.mean,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+class Profiler:
+    """
+    Collects timings from the task loop. Pass an instance to :func:`~approxeng.task.run` to record how long each task
+    tick, resource evaluation, check task, and task startup and shutdown takes. Timings are kept in a
+    :class:`~approxeng.task.profiling.Histogram` for each category and name, so memory use doesn't grow with the
+    length of the run.
+
+    Categories recorded by the task loop are:
+
+        * ``tick`` - time taken by each task's tick, including building its world
+        * ``resource`` - time taken by each resource's value method
+        * ``check`` - time taken by each check task function
+        * ``startup`` and ``shutdown`` - time taken to start and stop each task, including its resources
+        * ``resource_startup`` and ``resource_shutdown`` - time taken to start and stop each resource
+    """
+
+    def __init__(self, log_on_exit=True, **histogram_args):
+        """
+        :param log_on_exit:
+            If True, the task loop logs a report of all timings when it exits
+        :param histogram_args:
+            Any additional arguments are passed to the constructor of each
+            :class:`~approxeng.task.profiling.Histogram`
+        """
+        self.log_on_exit = log_on_exit
+        self.histogram_args = histogram_args
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, category, name, seconds):
+        """
+        Record a single timing. Safe to call from multiple threads.
+
+        :param category:
+            Category, such as 'tick' or 'resource'
+        :param name:
+            Name of the thing timed, such as a task or resource name
+        :param seconds:
+            Duration in seconds
+        """
+        key = (category, name)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(**self.histogram_args)
+                self.histograms[key] = histogram
+            histogram.add(seconds)
+
+    def time(self, category, name, func, *args, **kwargs):
+        """
+        Call a function, recording how long it took, and return its result.
+        """
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(category, name, perf_counter() - start)
+
+    def summary(self):
+        """
+        :return:
+            A dict of category to dict of name to the summary dict from
+            :meth:`~approxeng.task.profiling.Histogram.summary`
+        """
+        with self._lock:
+            result = {}
+            for (category, name), histogram in self.histograms.items():
+                result.setdefault(category, {})[name] = histogram.summary()
+            return result
+
+    def report(self):
+        """
+        :return:
+            A human readable table of all timings, in milliseconds
+        """
+        lines = ['{:<10} {:<30} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'category', 'name', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for category, names in sorted(self.summary().items()):
+            for name, s in sorted(names.items(), key=lambda item: str(item[0])):
+                lines.append('{:<10} {:<30} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                    category, str(name), s['count'], s['mean'] * 1000, s['p50'] * 1000, s['p95'] * 1000,
+                    s['p99'] * 1000, s['max'] * 1000))
+        return '\n'.join(lines)
+
+    def reset(self):
+        """
+        Discard all recorded timings.
+        """
+        with self._lock:
+            self.histograms.clear()
@@ -0,0 +1,280 @@
+import logging
+import mmap
+import os
+import pickle
+import struct
+from collections import namedtuple
+from time import perf_counter
+
+from approxeng.task import DEFAULT_LOOP, Resource, Task, TaskException
+
+LOG = logging.getLogger('approxeng.task.trace')
+
+# Identifies trace files, and the version of the format
+MAGIC = b'APXTRC01'
+# Each record is preceded by its length, a length of zero marks the end of the records
+_LENGTH = struct.Struct('<I')
+
+TickRecord = namedtuple('TickRecord', ['global_count', 'time', 'task', 'values', 'response'])
+TickRecord.__doc__ = """
+A single tick read from a trace. Contains the global count at the start of the tick, seconds since recording started,
+the name of the active task, a dict of resource name to the value seen during the tick, and the tick's response. Task
+objects returned from the tick are recorded as their names.
+"""
+
+
+def _describe_response(response):
+    if isinstance(response, Task):
+        return response.name
+    return response
+
+
+class TraceRecorder:
+    """
+    Records the inputs and outputs of each tick of a task loop to a file, pass an instance to
+    :func:`~approxeng.task.run` to use it. Each tick is pickled and appended to a memory mapped file, which is extended
+    in chunks as needed, so recording a tick costs little more than pickling its values. Values which can't be pickled
+    are recorded as their repr.
+
+    If the process dies without closing the recorder, the records written so far can still be read.
+
+    .. code-block:: python
+
+        from approxeng.task import run
+        from approxeng.task.trace import TraceRecorder
+
+        with TraceRecorder('run.trace') as recorder:
+            run(root_task='main_menu', recorder=recorder)
+    """
+
+    def __init__(self, path, chunk_size=1 << 20):
+        """
+        :param path:
+            File to write, any existing file is replaced
+        :param chunk_size:
+            Number of bytes to extend the file by when it's full
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.ticks = 0
+        self._file = open(path, 'w+b')
+        self._size = chunk_size
+        self._file.truncate(self._size)
+        self._mmap = mmap.mmap(self._file.fileno(), self._size)
+        self._mmap[:len(MAGIC)] = MAGIC
+        self._position = len(MAGIC)
+        self._start = perf_counter()
+
+    def record(self, global_count, task_name, values, response):
+        """
+        Append a single tick to the trace.
+
+        :param global_count:
+            Global tick count at the start of the tick
+        :param task_name:
+            Name of the active task
+        :param values:
+            Dict of resource name to value, as seen by the tick
+        :param response:
+            The tick's response, or that of a check task if one responded
+        """
+        record = (global_count, perf_counter() - self._start, task_name, values, _describe_response(response))
+        try:
+            data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = pickle.dumps(self._picklable(record), protocol=pickle.HIGHEST_PROTOCOL)
+        end = self._position + _LENGTH.size + len(data)
+        # Always leave room for a terminating zero length
+        if end + _LENGTH.size > self._size:
+            self._grow(end + _LENGTH.size)
+        _LENGTH.pack_into(self._mmap, self._position, len(data))
+        self._mmap[self._position + _LENGTH.size:end] = data
+        self._position = end
+        self.ticks += 1
+
+    @staticmethod
+    def _picklable(record):
+        """
+        Replace anything in a record which can't be pickled with its repr.
+        """
+
+        def picklable(value):
+            try:
+                pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                return value
+            except Exception:
+                return repr(value)
+
+        global_count, time, task_name, values, response = record
+        return (global_count, time, task_name, {name: picklable(value) for name, value in values.items()},
+                picklable(response))
+
+    def _grow(self, minimum_size):
+        self._mmap.close()
+        self._size = max(self._size + self.chunk_size, minimum_size)
+        self._file.truncate(self._size)
+        self._mmap = mmap.mmap(self._file.fileno(), self._size)
+
+    def close(self):
+        """
+        Flush the trace to disk and truncate the file to the records written.
+        """
+        if self._mmap is None:
+            return
+        self._mmap.flush()
+        self._mmap.close()
+        self._mmap = None
+        self._file.truncate(self._position)
+        self._file.close()
+        LOG.info('Recorded %i ticks to "%s"', self.ticks, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TraceReader:
+    """
+    Reads the ticks recorded by a :class:`~approxeng.task.trace.TraceRecorder`. Iterating over the reader yields a
+    :class:`~approxeng.task.trace.TickRecord` for each tick. Records are unpickled, so only read traces you trust.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise TaskException('"{}" is not a trace file'.format(path))
+            if os.fstat(f.fileno()).st_size > len(MAGIC):
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mmap = b''
+
+    def __iter__(self):
+        data = self._mmap
+        position = len(MAGIC)
+        while position + _LENGTH.size <= len(data):
+            length, = _LENGTH.unpack_from(data, position)
+            if length == 0:
+                break
+            position += _LENGTH.size
+            yield TickRecord(*pickle.loads(data[position:position + length]))
+            position += length
+
+    def resource_names(self):
+        """
+        :return:
+            Set of the names of all resources recorded in the trace
+        """
+        names = set()
+        for record in self:
+            names.update(record.values.keys())
+        return names
+
+
+class ReplayResource(Resource):
+    """
+    Stands in for a recorded resource when replaying a trace, returning the value recorded for the current tick.
+    """
+
+    def __init__(self, name, replay):
+        super(ReplayResource, self).__init__(name=name)
+        self.replay = replay
+
+    def startup(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def value(self, **kwargs):
+        return self.replay.value(self.name)
+
+
+class TraceReplay:
+    """
+    Replays a trace recorded by a :class:`~approxeng.task.trace.TraceRecorder`, pass an instance to
+    :func:`~approxeng.task.run` to use it. All the resources in the trace are replaced by instances of
+    :class:`~approxeng.task.trace.ReplayResource`, so each tick sees the values recorded for the corresponding tick of
+    the original run. Whenever the active task or its response differs from the recording this is logged and added to
+    the mismatches list, so replays can be used to check that changes to task logic haven't altered its behaviour.
+
+    .. code-block:: python
+
+        from approxeng.task import run
+        from approxeng.task.trace import TraceReplay
+
+        replay = TraceReplay('run.trace')
+        run(root_task='main_menu', replay=replay)
+        assert not replay.mismatches
+    """
+
+    def __init__(self, path):
+        self.reader = TraceReader(path)
+        self.current = None
+        self.ticks = 0
+        # List of (tick, recorded TickRecord, replayed task name, replayed response)
+        self.mismatches = []
+        self._records = None
+
+    def install(self, loop=None):
+        """
+        Replace the recorded resources in a loop with ones returning the recorded values, and start from the first
+        tick. Called by the task loop when it starts.
+
+        :param loop:
+            The :class:`~approxeng.task.TaskLoop`, defaults to the default loop
+        """
+        if loop is None:
+            loop = DEFAULT_LOOP
+        for name in sorted(self.reader.resource_names()):
+            loop.register_resource(name, ReplayResource(name=name, replay=self))
+        self._records = iter(self.reader)
+        self.current = None
+        self.ticks = 0
+
+    def advance(self):
+        """
+        Move on to the next recorded tick.
+
+        :return:
+            True if there was another tick, False if the trace has been used up
+        """
+        if self._records is None:
+            self._records = iter(self.reader)
+        self.current = next(self._records, None)
+        if self.current is None:
+            LOG.info('Replayed %i ticks from "%s", %i mismatches', self.ticks, self.reader.path, len(self.mismatches))
+            return False
+        self.ticks += 1
+        return True
+
+    def value(self, name):
+        """
+        The value of a resource in the current tick.
+        """
+        values = self.current.values
+        if name not in values:
+            raise TaskException('Resource "{}" was not recorded on tick {}'.format(name, self.current.global_count))
+        return values[name]
+
+    def check(self, task_name, response):
+        """
+        Compare the active task and response from a replayed tick with those recorded, noting any difference.
+        """
+        recorded = self.current
+        response = _describe_response(response)
+        if recorded.task != task_name or not _same_response(recorded.response, response):
+            LOG.warning('Replay mismatch on tick %i, recorded %s -> %r, replayed %s -> %r', recorded.global_count,
+                        recorded.task, recorded.response, task_name, response)
+            self.mismatches.append((self.ticks, recorded, task_name, response))
+
+
+def _same_response(recorded, replayed):
+    if type(recorded) is not type(replayed):
+        return False
+    # TaskStop doesn't define equality, so compare the wrapped values
+    if hasattr(replayed, 'return_value'):
+        return recorded.return_value == replayed.return_value
+    return recorded == replayed
@@ -13,6 +13,7 @@ setup(
     license='ASL2.0',
     packages=find_namespace_packages(),
     install_requires=['pyyaml==5.3'],
+    extras_require={'history': ['numpy']},
     include_package_data=True,
     dependency_links=[],
     zip_safe=False)